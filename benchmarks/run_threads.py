@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Overhead of multibuild itself measured with stand-ins of the build system.
+
+    python3 benchmarks/run_threads.py [-b 1,10,50,200] [-m build,summary,tag,pipeline]
+                                      [--latency S]
+
+A temporary dist-git repo with N branches is created and 'execute_thread_approach'
+runs against it. 'rhpkg' and 'brew' are stub executables on PATH sleeping for
+'--latency' seconds; koji ClientSession is replaced by a fake one sleeping for
+'--hub-latency' seconds per round trip. Every run is executed in its own process
+and wall-clock time, per-phase latency and peak RSS are reported. Branches failing
+against the stand-ins (according to the run's journal) are reported and the exit
+status is non-zero then.
+"""
+
+import argparse
+import collections
+import configparser
+import glob
+import json
+import logging
+import os
+import resource
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+MODES = {
+    "build": ["-b"],
+    "nowait": ["-b", "--nowait"],
+    "summary": ["-p"],
+    "tag": ["-t"],
+    "custom": ["-e", "true"],
+    "pipeline": ["--pipeline", "build,tag"],
+}
+
+SPEC = """\
+%global pkg_version 1.0
+Name: bench
+Version: %{pkg_version}
+Release: 1%{?dist}
+"""
+
+STUB = """\
+#!/bin/sh
+# the branch is read before the first line is printed - the checkout can change then
+branch=$(git rev-parse --abbrev-ref HEAD)
+nvr="bench-1.0-1.el${branch##*-}"
+sleep "${MULTIBUILD_STUB_LATENCY:-0}"
+case "$1" in
+verrel) echo "$nvr";;
+build|scratch-build)
+    echo "Building bench for $branch"
+    echo "Created task: $$"
+    # the fake hub knows the build from now on
+    if [ "$1" = build ]; then
+        touch "$MULTIBUILD_STUB_BUILT/$nvr"
+    fi;;
+*) echo "$@";;
+esac
+"""
+
+
+def install_fake_koji(hub_latency, built):
+    """
+    Fake koji session; the koji module itself is faked when it isn't installed.
+    built: function telling whether the NVR was built before the run; builds submitted
+    by the stub commands are known as well
+    Returns counter of hub round trips.
+    """
+    try:
+        import koji
+    except ImportError:
+        koji = types.ModuleType("koji")
+        koji.BUILD_STATES = {"BUILDING": 0, "COMPLETE": 1, 0: "BUILDING", 1: "COMPLETE"}
+        koji.TASK_STATES = {2: "CLOSED"}
+        koji.parse_NVR = lambda nvr: {"name": nvr.rsplit("-", 2)[0]}
+        sys.modules["koji"] = koji
+
+    from multibuild.kojiwrapper import Kojiwrapper
+
+    round_trips = collections.Counter()
+
+    class FakeSession(object):
+        multicall = False
+
+        def __init__(self):
+            self.calls = []
+
+        def call(self, method, result):
+            if self.multicall:
+                self.calls.append(result)
+                return None
+            round_trips[method] += 1
+            time.sleep(hub_latency)
+            return result
+
+        def multiCall(self, strict=False):
+            round_trips["multiCall"] += 1
+            time.sleep(hub_latency)
+            results, self.calls, self.multicall = self.calls, [], False
+            return [[result] for result in results]
+
+        def getBuild(self, nvr):
+            build = {"nvr": nvr, "build_id": 1, "task_id": 1, "state": 1}
+            built_now = os.path.exists(os.path.join(os.environ.get("MULTIBUILD_STUB_BUILT", ""),
+                                                    nvr))
+            return self.call("getBuild", build if built(nvr) or built_now else None)
+
+        def listTags(self, nvr):
+            return self.call("listTags", [{"name": "{}-candidate".format(nvr)}])
+
+        def getTaskInfo(self, task_id):
+            return self.call("getTaskInfo", {"id": task_id, "state": 2})
+
+        def getRepo(self, tag):
+            return self.call("getRepo", {"id": 1, "create_event": 1, "create_ts": 0})
+
+        def getLatestBuilds(self, tag, event=None, package=None):
+            branch = tag[:-len("-build")]
+            nvr = "bench-1.0-1.el{}".format(branch.rsplit("-", 1)[-1])
+            return self.call("getLatestBuilds", [{"nvr": nvr}])
+
+    Kojiwrapper.load_anon_kojisession = lambda self: FakeSession()
+    return round_trips
+
+
+def prepare_repo(work_dir, branches):
+    repo = os.path.join(work_dir, "bench")
+    os.makedirs(repo)
+    git = ["git", "-c", "user.name=bench", "-c", "user.email=bench@localhost"]
+    subprocess.run(git + ["init", "-q"], cwd=repo, check=True)
+    with open(os.path.join(repo, "bench.spec"), "w") as spec_file:
+        spec_file.write(SPEC)
+    subprocess.run(git + ["add", "bench.spec"], cwd=repo, check=True)
+    subprocess.run(git + ["commit", "-q", "-m", "init"], cwd=repo, check=True)
+    for branch in branches:
+        subprocess.run(git + ["branch", branch], cwd=repo, check=True)
+    # pushed branches pass the preflight check
+    origin = os.path.join(work_dir, "origin.git")
+    subprocess.run(git + ["init", "-q", "--bare", origin], check=True)
+    subprocess.run(git + ["remote", "add", "origin", origin], cwd=repo, check=True)
+    subprocess.run(git + ["push", "-q", "-u", "origin", "--all"], cwd=repo, check=True,
+                   stderr=subprocess.DEVNULL)
+
+    bin_dir = os.path.join(work_dir, "bin")
+    os.makedirs(bin_dir)
+    for tool in ("rhpkg", "brew"):
+        path = os.path.join(bin_dir, tool)
+        with open(path, "w") as stub_file:
+            stub_file.write(STUB)
+        os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+    return repo, bin_dir
+
+
+def summarize_phases(metrics):
+    """
+    {phase: {"count", "mean", "max"}} of all branches from the run's metrics
+    """
+    durations = collections.defaultdict(list)
+    for record in metrics["branches"].values():
+        for phase, values in record["phases"].items():
+            durations[phase] += [values["seconds"] / values["count"]] * values["count"]
+    return {phase: {"count": len(values), "mean": sum(values) / len(values), "max": max(values)}
+            for phase, values in durations.items()}
+
+
+def failed_branches(git_dir):
+    """branches whose last journaled stage failed (in journals of all kinds of work)"""
+    states = {}
+    for journal_path in glob.glob(os.path.join(git_dir, "multibuild-journal-*.jsonl")):
+        with open(journal_path) as journal_file:
+            for line in journal_file:
+                entry = json.loads(line)
+                states[entry["branch"]] = entry["succeeded"]
+    return sorted(branch for branch, succeeded in states.items() if not succeeded)
+
+
+def run_single(branch_count, mode, options):
+    """
+    one benchmark run in this process; result is printed as JSON
+    """
+    from multibuild import execute_thread_approach, prepare_parser
+    from multibuild.logbuffer import LogBuffer
+    from multibuild.metrics import run_metrics
+
+    logging.basicConfig(level=logging.CRITICAL)
+    if mode in ("build", "nowait", "pipeline"):
+        # the first branches are built already; see '--built'
+        def built(nvr):
+            return int(nvr.rsplit(".el", 1)[-1]) <= options.built * branch_count
+    else:
+        def built(nvr):
+            return True
+    round_trips = install_fake_koji(options.hub_latency, built)
+
+    branches = ["eng-rhel-{}".format(i + 1) for i in range(branch_count)]
+    work_dir = tempfile.mkdtemp(prefix="multibuild-bench-")
+    try:
+        repo, bin_dir = prepare_repo(work_dir, branches)
+        os.environ["PATH"] = bin_dir + os.pathsep + os.environ["PATH"]
+        os.environ["MULTIBUILD_STUB_LATENCY"] = str(options.latency)
+        os.environ["MULTIBUILD_STUB_BUILT"] = os.path.join(work_dir, "built")
+        os.makedirs(os.environ["MULTIBUILD_STUB_BUILT"])
+        os.chdir(repo)
+
+        argv = MODES[mode] + options.extra + branches
+        args = prepare_parser().parse_args(argv)
+        config = configparser.ConfigParser()
+        config.read_dict({"general": {
+            "native_wait_repo": "yes",
+            "worktree_dir": os.path.join(work_dir, "worktrees"),
+        }})
+        start = time.monotonic()
+        with open(os.devnull, "w") as devnull:
+            stdout, sys.stdout = sys.stdout, devnull
+            try:
+                execute_thread_approach(args, config, logging.getLogger("main"), LogBuffer())
+            finally:
+                sys.stdout = stdout
+        wall_clock = time.monotonic() - start
+        failed = failed_branches(os.path.join(repo, ".git"))
+    finally:
+        os.chdir(REPO_DIR)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print(json.dumps({
+        "branches": branch_count,
+        "mode": mode,
+        "wall_clock": wall_clock,
+        "failed": failed,
+        "phases": summarize_phases(run_metrics.to_dict()),
+        "round_trips": sum(round_trips.values()),
+        # kilobytes on Linux
+        "peak_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }))
+
+
+def report(result):
+    print("{mode:<8} {branches:>5} branches  {wall_clock:8.2f} s  {round_trips:>5} hub calls  "
+          "peak RSS {peak_rss:>7} kB".format(**result))
+    if result["failed"]:
+        print("    FAILED: {}".format(", ".join(result["failed"])))
+    for phase, values in sorted(result["phases"].items()):
+        print("    {:<20} n={:<5} mean {:7.3f} s  max {:7.3f} s".format(
+            phase, values["count"], values["mean"], values["max"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="measure overhead of multibuild")
+    parser.add_argument("-b", "--branches", default="1,10,50,200",
+                        help="comma-separated numbers of branches (default: 1,10,50,200)")
+    parser.add_argument("-m", "--modes", default="build,summary,tag,pipeline",
+                        help="comma-separated modes: {}".format(",".join(MODES)))
+    parser.add_argument("--latency", type=float, default=0.1,
+                        help="latency of stub rhpkg/brew commands in seconds")
+    parser.add_argument("--hub-latency", type=float, default=0.05,
+                        help="latency of a koji hub round trip in seconds")
+    parser.add_argument("--built", type=float, default=0,
+                        help="fraction of branches already built (build modes; default: 0)")
+    parser.add_argument("--single", nargs=2, metavar=("BRANCHES", "MODE"),
+                        help=argparse.SUPPRESS)
+    parser.add_argument("extra", nargs="*",
+                        help="extra multibuild arguments (after '--'), e.g. --worktrees")
+    options = parser.parse_args()
+
+    if options.single:
+        run_single(int(options.single[0]), options.single[1], options)
+        return 0
+
+    failed = False
+    for mode in options.modes.split(","):
+        for branch_count in options.branches.split(","):
+            command = [sys.executable, os.path.abspath(__file__), "--single", branch_count, mode,
+                       "--latency", str(options.latency),
+                       "--hub-latency", str(options.hub_latency),
+                       "--built", str(options.built), "--"] + options.extra
+            proc = subprocess.run(command, stdout=subprocess.PIPE, universal_newlines=True)
+            if proc.returncode:
+                print("{} {} branches: failed".format(mode, branch_count))
+                failed = True
+                continue
+            result = json.loads(proc.stdout.splitlines()[-1])
+            failed = failed or bool(result["failed"])
+            report(result)
+    # branches failing against the stand-ins are bugs of multibuild
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
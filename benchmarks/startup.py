@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Startup time of multibuild measured by 'python -X importtime'.
+
+    python3 benchmarks/startup.py [-n RUNS]
+
+It reports cumulative import time of multibuild, the slowest imported modules
+and wall-clock time of 'multibuild --help'. It fails when a heavy module
+(koji, requests, asyncio) is imported at startup.
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+HEAVY_MODULES = ("koji", "requests", "asyncio")
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_times():
+    """
+    {module: cumulative import time in microseconds} of 'import multibuild'
+    """
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", "import multibuild"],
+                          cwd=REPO_DIR, stderr=subprocess.PIPE, universal_newlines=True,
+                          check=True)
+    times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        __, cumulative, module = line.split("|")
+        if cumulative.strip().isdigit():
+            times[module.strip()] = int(cumulative)
+    return times
+
+
+def help_time():
+    start = time.monotonic()
+    subprocess.run([sys.executable, "-m", "multibuild", "--help"], cwd=REPO_DIR,
+                   stdout=subprocess.DEVNULL, check=True)
+    return time.monotonic() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="measure startup time of multibuild")
+    parser.add_argument("-n", "--runs", type=int, default=5, help="number of runs")
+    args = parser.parse_args()
+
+    runs = [import_times() for __ in range(args.runs)]
+    totals = [times["multibuild"] / 1000.0 for times in runs]
+    message = "import multibuild: {:.1f} ms (median of {} runs)"
+    print(message.format(statistics.median(totals), args.runs))
+    print("slowest imports:")
+    last = runs[-1]
+    for module in sorted(last, key=last.get, reverse=True)[:10]:
+        print("  {:>8.1f} ms  {}".format(last[module] / 1000.0, module))
+
+    helps = [help_time() for __ in range(args.runs)]
+    print("multibuild --help: {:.1f} ms (median)".format(statistics.median(helps) * 1000))
+
+    heavy = [module for module in HEAVY_MODULES if module in last]
+    if heavy:
+        print("heavy modules imported at startup: {}".format(", ".join(heavy)))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
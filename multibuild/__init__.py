@@ -3,23 +3,46 @@
 
 # TODO: import argcomplete
 import argparse
+import collections
 import configparser
+import hashlib
 import logging
 import os
 import site
 import sys
+import threading
 import time
 from textwrap import dedent
 
-from . build_thread import BuildThread
+from . build_thread import PIPELINE_STAGES, BuildThread
+from . buildcache import DEFAULT_MAX_ENTRIES, DEFAULT_TTL, BuildCache
 from . color_formatter import ColorFormatter
+from . credentials import get_ansible_credentials
+from . journal import Journal
+from . kojiwrapper import Kojiwrapper
 from . logbuffer import LogBuffer
-from .tools import (detect_distribution, execute_command,
-                    get_distribution_tool, get_ansible_credentials)
+from . logdownloader import LogDownloader
+from . metrics import run_metrics
+from . preflight import Preflight, get_preflight_actions
+from . repowaiter import DEFAULT_TIMEOUT, RepoWaiter
+from . resolver import BranchResolver
+from . scheduler import DEFAULT_MAX_WORKERS, Scheduler
+from . settings import load_settings
+from . taskwatcher import DEFAULT_TIMEOUT as WATCH_TIMEOUT, TaskWatcher
+from .tools import (ANSIBLE_FOLLOW_TIMEOUT, detect_distribution, follow_ansible_jobs,
+                    get_distribution_tool, prepare_worktree, release_worktree)
 
 # TODO: find reliable way how to install config to ~/.config/ instead of ~/.local/
 DEFAULT_CONFIG_PATH = "{}/multibuild".format(site.USER_BASE)
 CONFIG_FILE_NAME = "multibuild.conf"
+BUILD_CACHE_FILE_NAME = "build_cache.json"
+CREDENTIALS_FILE_NAME = "credentials.json"
+# every kind of work (see 'get_journal_kind') has its own journal
+JOURNAL_FILE_NAME = "multibuild-journal-{}.jsonl"
+# lines of output kept per branch in streaming mode
+DEFAULT_MAX_OUTPUT_LINES = 1000
+DEFAULT_MAX_OUTPUT_BYTES = 1024 * 1024
+WORKTREES_DIR_NAME = "worktrees"
 
 # ===============================
 # improvements to be implemented
@@ -29,7 +52,6 @@ CONFIG_FILE_NAME = "multibuild.conf"
 # add command "download" packages from brew (no src packages)
 # verify whether builds are tagged when printing the RCM ticket template
 # verify whether builds are tagged before regen RCM repo
-# remove configparser dependency in build_thread.py
 # in setup.py add dependency on setuptools_scm to rely on version from scm
 # and include just files that are tracked.
 # ...
@@ -56,6 +78,388 @@ def get_branches(args, config, logger):
     return branches
 
 
+def get_repos(args, config):
+    """
+    directories of dist-git repos from command-line or 'repos' value in [general] section;
+    empty list means the current directory
+    """
+    repos = args.repos or []
+    if not repos:
+        try:
+            raw_repos = config.get("general", "repos")
+            repos = [repo.strip() for repo in raw_repos.split(",") if repo.strip()]
+        except (configparser.NoOptionError, configparser.NoSectionError):
+            pass
+    return [os.path.abspath(os.path.expanduser(repo)) for repo in repos]
+
+
+def get_repo_config(config, repo_dir):
+    """
+    config of the dist-git repo - the main config updated by the repo's config file
+    """
+    logger = logging.getLogger("get_repo_config")
+    repo_config = configparser.ConfigParser()
+    repo_config.read_dict({section: dict(config.items(section, raw=True))
+                           for section in config.sections()})
+    config_file = os.path.join(repo_dir, CONFIG_FILE_NAME)
+    if os.path.isfile(config_file):
+        logger.debug("Will use a extra config file: {}".format(config_file))
+        repo_config.read(config_file)
+    return repo_config
+
+
+def use_worktrees(args, config):
+    """
+    worktree mode is enabled from command-line or by config value; scratch builds
+    and custom commands use it by default - they read the working tree while they run
+    and they would wait for each other in the shared checkout
+    """
+    if args.worktrees:
+        return True
+    try:
+        return config.getboolean("general", "worktrees")
+    except (configparser.NoOptionError, configparser.NoSectionError, ValueError):
+        return bool(args.do_scratch_build or args.execute_custom)
+
+
+def get_worktree_root(config, repo_dir=None):
+    """
+    directory where worktrees of the project's branches are cached
+    """
+    try:
+        worktree_dir = config.get("general", "worktree_dir")
+    except (configparser.NoOptionError, configparser.NoSectionError):
+        worktree_dir = None
+    if not worktree_dir:
+        worktree_dir = os.path.join(DEFAULT_CONFIG_PATH, WORKTREES_DIR_NAME)
+    # worktrees of different projects (even of the same name) are separated
+    repo_dir = os.path.realpath(repo_dir or os.getcwd())
+    project = "{}-{}".format(os.path.basename(repo_dir),
+                             hashlib.sha1(repo_dir.encode()).hexdigest()[:8])
+    return os.path.join(os.path.expanduser(worktree_dir), project)
+
+
+def release_worktrees(worktrees):
+    """
+    let go of the branches of cached worktrees [(branch, path), ...]; they stay checked out
+    in the worktrees otherwise and 'git checkout' of them fails in the repo
+    """
+    for branch, path in worktrees:
+        if path:
+            release_worktree(branch, path)
+
+
+def get_max_workers(config, section, default=None):
+    """
+    read 'max_workers' value of the section
+    """
+    try:
+        return config.getint(section, "max_workers") or default
+    except (configparser.NoOptionError, configparser.NoSectionError):
+        return default
+
+
+def get_journal_kind(args):
+    """
+    Kind of the run's work. Runs of other kinds (e.g. checking the summary) don't start
+    the journal of an interrupted build again; custom commands are told apart too.
+    """
+    if args.execute_custom:
+        return "custom-" + hashlib.sha1(args.execute_custom.encode()).hexdigest()[:8]
+    kinds = (
+        ("build", args.do_build),
+        ("scratch-build", args.do_scratch_build),
+        ("tag", args.do_tag),
+        ("summary", args.do_summary or args.do_jira),
+        ("wait-repo", args.wait_repo),
+        ("regen", args.regen_rcm_repo),
+    )
+    for kind, enabled in kinds:
+        if enabled:
+            return kind
+    return "pipeline"
+
+
+def get_journal_path(kind, repo_dir=None):
+    """
+    journal of the kind of work is kept in git directory of the project
+    (or in the project's directory)
+    """
+    repo_dir = repo_dir or os.getcwd()
+    git_dir = os.path.join(repo_dir, ".git")
+    file_name = JOURNAL_FILE_NAME.format(kind)
+    if os.path.isdir(git_dir):
+        return os.path.join(git_dir, file_name)
+    return os.path.join(repo_dir, file_name)
+
+
+def get_scheduler(args, config, logger):
+    """
+    Scheduler limited by 'max_workers' from command-line or [general] section
+    and by 'max_workers' of [brew]/[koji] sections. Branches listed
+    in 'priority' value of [branches] section are processed first.
+    The asyncio engine is selected by '--engine' argument or 'engine' value
+    in [general] section.
+    """
+    try:
+        max_workers = args.max_workers or get_max_workers(config, "general",
+                                                          DEFAULT_MAX_WORKERS)
+        tool_limits = {server_tool: get_max_workers(config, server_tool)
+                       for server_tool in ("brew", "koji")}
+    except ValueError as e:
+        logger.warning("Invalid 'max_workers' value in config: {}".format(e))
+        max_workers = args.max_workers or DEFAULT_MAX_WORKERS
+        tool_limits = {}
+
+    priority = []
+    try:
+        raw_priority = config.get("branches", "priority")
+        priority = [branch.strip() for branch in raw_priority.split(",") if branch.strip()]
+    except (configparser.NoOptionError, configparser.NoSectionError):
+        pass
+
+    engine = args.engine
+    if not engine:
+        try:
+            engine = config.get("general", "engine")
+        except (configparser.NoOptionError, configparser.NoSectionError):
+            engine = "threads"
+    if engine == "async":
+        # asyncio is imported just when it is used
+        from . async_scheduler import AsyncScheduler
+        return AsyncScheduler(max_workers, tool_limits, priority, timeout=args.timeout)
+    if engine != "threads":
+        logger.warning("Unknown engine '{}'. Using 'threads'".format(engine))
+    # build tasks and ansible jobs are watched with the timeout by both engines
+    watching = (args.nowait or args.do_build or args.follow
+                or "build" in (args.pipeline or ()))
+    if args.timeout and not (args.wait_repo or watching):
+        logger.warning("Timeout is supported by the 'async' engine only")
+    return Scheduler(max_workers, tool_limits, priority)
+
+
+def get_build_cache(config, logger):
+    """
+    Persistent cache of completed builds. Its expiration (in days) and size are
+    set by 'cache_ttl' and 'cache_max_entries' values in [general] section.
+    """
+    ttl = DEFAULT_TTL
+    max_entries = DEFAULT_MAX_ENTRIES
+    try:
+        if config.has_option("general", "cache_ttl"):
+            ttl = config.getfloat("general", "cache_ttl") * 24 * 3600
+        if config.has_option("general", "cache_max_entries"):
+            max_entries = config.getint("general", "cache_max_entries")
+    except ValueError as e:
+        logger.warning("Invalid build cache value in config: {}".format(e))
+    cache_file = os.path.join(DEFAULT_CONFIG_PATH, BUILD_CACHE_FILE_NAME)
+    return BuildCache(cache_file, ttl, max_entries)
+
+
+def prepare_log_buffer(args, config, logger):
+    """
+    Output of branches is kept in memory up to 'max_output_bytes' (per branch) value
+    in [general] section; the complete output is spilled to a file then.
+    Number of the last lines kept while streaming is set by 'max_output_lines'.
+    """
+    max_lines = None
+    if args.stream or args.log_dir:
+        max_lines = DEFAULT_MAX_OUTPUT_LINES
+        try:
+            max_lines = config.getint("general", "max_output_lines")
+        except (configparser.NoOptionError, configparser.NoSectionError):
+            pass
+        except ValueError as e:
+            logger.warning("Invalid 'max_output_lines' value in config: {}".format(e))
+    max_bytes = DEFAULT_MAX_OUTPUT_BYTES
+    try:
+        max_bytes = config.getint("general", "max_output_bytes")
+    except (configparser.NoOptionError, configparser.NoSectionError):
+        pass
+    except ValueError as e:
+        logger.warning("Invalid 'max_output_bytes' value in config: {}".format(e))
+    log_dir = args.log_dir and os.path.expanduser(args.log_dir)
+    return LogBuffer(stream=args.stream, max_lines=max_lines, log_dir=log_dir,
+                     max_bytes=max_bytes or None)
+
+
+def run_preflight(branches, config, logger, repo_dir=None):
+    """
+    Check branches against their remote branches before builds are submitted
+    and handle the problems as [preflight] section says. Branches with unpushed
+    commits are pushed with 'unpushed=push'.
+    Returns False when builds must not be submitted.
+    """
+    try:
+        if not config.getboolean("preflight", "enabled"):
+            return True
+    except (configparser.NoOptionError, configparser.NoSectionError):
+        pass
+    fetch = True
+    try:
+        fetch = config.getboolean("preflight", "fetch")
+    except (configparser.NoOptionError, configparser.NoSectionError):
+        pass
+    actions = get_preflight_actions(config)
+
+    preflight = Preflight(branches, cwd=repo_dir)
+    with run_metrics.measure("preflight"):
+        states = preflight.check(fetch=fetch)
+    problems = preflight.find_problems(states)
+    if not any(problems.values()):
+        return True
+    Preflight.print_table(states)
+
+    if problems["missing"]:
+        logger.error("Missing branches: {}".format(", ".join(problems["missing"])))
+        return False
+    descriptions = {
+        "unpushed": "Branches with unpushed commits (or without remote branch)",
+        "behind": "Branches behind their remote branch",
+        "dirty": "Branches with uncommitted changes",
+    }
+    ready = True
+    for problem, description in descriptions.items():
+        branches_in_state = problems[problem]
+        if not branches_in_state or actions[problem] == "ignore":
+            continue
+        message = "{}: {}".format(description, ", ".join(branches_in_state))
+        if actions[problem] == "push":
+            logger.info("{}. Pushing them".format(message))
+            ready = preflight.push(branches_in_state, states) and ready
+        elif actions[problem] == "refuse":
+            logger.error("{}. Builds won't be submitted".format(message))
+            ready = False
+        else:
+            logger.warning(message)
+    return ready
+
+
+def group_by_server_tool(threads):
+    """threads split by build systems of their branches: {server_tool: [thread, ...]}"""
+    groups = collections.OrderedDict()
+    for thread in threads:
+        groups.setdefault(thread.server_tool, []).append(thread)
+    return groups
+
+
+def prefetch_builds(scheduler, threads, tags=False):
+    """
+    Resolve NVRs of all branches first and then look them up in koji in one batch
+    (per build system) instead of a round trip per branch. With 'tags', tags of
+    existing builds are loaded in the next batch.
+    """
+    logger = logging.getLogger("prefetch_builds")
+    verrels = scheduler.run(threads, lambda thread: thread.resolve_nvr())
+    for server_tool, group in group_by_server_tool(threads).items():
+        kojiwrapper = Kojiwrapper.get_instance(server_tool)
+        group_verrels = [verrels[thread.name] for thread in group]
+        try:
+            with run_metrics.measure("koji lookup"):
+                kojiwrapper.prefetch_builds(group_verrels)
+                if tags:
+                    kojiwrapper.prefetch_tags([verrel for verrel in group_verrels
+                                               if kojiwrapper.builds.get(verrel)])
+        except Exception as e:
+            # threads will try to get builds one by one
+            logger.error("prefetch_builds: {}".format(e))
+
+
+def wait_for_repos(scheduler, threads, timeout, log_buff):
+    """
+    Wait for regeneration of all branches' build tags with their builds in one poller
+    per build system. Returns results per branch like BuildThread.wait_repo does (0 = ready).
+    Results are journaled; branches done in the resumed run are not waited for again.
+    """
+    resumed = collections.OrderedDict()
+    # checking the resumed run resolves NVRs of the branches
+    entries = scheduler.run(threads, lambda thread: thread.completed_stage("wait-repo"))
+    for thread in threads:
+        entry = entries[thread.name]
+        if entry:
+            resumed[thread.name] = thread.finish_stage("wait-repo", entry.get("result"),
+                                                       resumed=True)
+    waiting = [thread for thread in threads if thread.name not in resumed]
+    verrels = scheduler.run(waiting, lambda thread: thread.verrel or thread.resolve_nvr())
+    ready = {}
+    for server_tool, group in group_by_server_tool(waiting).items():
+        # builds of more repos can wait for the same tag
+        builds = collections.defaultdict(list)
+        for thread in group:
+            if verrels[thread.name]:
+                builds["{}-build".format(thread.branch)].append(verrels[thread.name])
+        waiter = RepoWaiter(Kojiwrapper.get_instance(server_tool),
+                            timeout=timeout or DEFAULT_TIMEOUT)
+        with run_metrics.measure("wait-repo"):
+            ready[server_tool] = waiter.wait(builds)
+
+    results = collections.OrderedDict()
+    for thread in threads:
+        if thread.name in resumed:
+            results[thread.name] = resumed[thread.name]
+            continue
+        tag = "{}-build".format(thread.branch)
+        verrel = verrels[thread.name]
+        tool_ready = ready[thread.server_tool]
+        results[thread.name] = None
+        if verrel and tag in tool_ready:
+            results[thread.name] = 0 if tool_ready[tag] else 1
+            state = "contains" if tool_ready[tag] else "doesn't contain"
+            message = "repo of '{}' {} '{}'".format(tag, state, verrel)
+            log_buff.append_output(thread.name, message)
+        thread.finish_stage("wait-repo", results[thread.name])
+    return results
+
+
+def watch_tasks(threads, task_ids, timeout, log_buff):
+    """
+    Watch submitted build tasks {branch: task_id} until they are finished; tasks
+    of each build system are watched through its own session.
+    Returns results per branch like a build command (0 = build succeeded).
+    """
+    states = {}
+    for server_tool, group in group_by_server_tool(threads).items():
+        group_task_ids = collections.OrderedDict((thread.name, task_ids.get(thread.name))
+                                                 for thread in group)
+        with run_metrics.measure("watch tasks"):
+            states.update(TaskWatcher(Kojiwrapper.get_instance(server_tool),
+                                      timeout=timeout or WATCH_TIMEOUT).watch(group_task_ids))
+    results = collections.OrderedDict()
+    for branch, task_id in task_ids.items():
+        results[branch] = None
+        if task_id:
+            results[branch] = 0 if states[branch] == "CLOSED" else 1
+            log_buff.append_output(branch, "\ntask {}: {}".format(task_id, states[branch]))
+    return results
+
+
+def follow_regen_jobs(ansible, results, timeout, log_buff):
+    """
+    wait until all launched ansible jobs (results of regen-rcm-repo threads) are finished
+    """
+    with run_metrics.measure("ansible jobs"):
+        jobs = follow_ansible_jobs(ansible.url, ansible.token, results,
+                                   timeout=timeout or ANSIBLE_FOLLOW_TIMEOUT)
+    for branch, job in jobs.items():
+        if job:
+            message = "\njob {}: {} ({:.0f} s)"
+            message = message.format(job["id"], job.get("status"), job.get("elapsed") or 0)
+            log_buff.append_output(branch, message)
+        elif results.get(branch):
+            log_buff.append_output(branch, "\njob {}: unknown".format(results[branch]))
+
+
+def parse_stages(value):
+    """
+    comma-separated pipeline stages
+    """
+    stages = [stage.strip() for stage in value.split(",") if stage.strip()]
+    unknown = [stage for stage in stages if stage not in PIPELINE_STAGES]
+    if unknown or not stages:
+        raise argparse.ArgumentTypeError("unknown stages: {}".format(", ".join(unknown)))
+    return stages
+
+
 def prepare_parser():
     parser = argparse.ArgumentParser(description='Apply specific action for each dist-git '
                                                  'branch in list')
@@ -65,6 +469,38 @@ def prepare_parser():
                         help='specifies config file (INI format)')
     parser.add_argument('-v', '--verbose', dest='verbose', action='store_true',
                         help='show debug information')
+    parser.add_argument('--repos', dest='repos', metavar="DIR", nargs='+',
+                        help='process the branches in each of the dist-git repos instead of '
+                             'the current directory')
+    parser.add_argument('--worktrees', dest='worktrees', action='store_true',
+                        help='process each branch in its own git worktree instead of switching '
+                             'branches in the current directory')
+    parser.add_argument('--no-cache', dest='no_cache', action='store_true',
+                        help='don\'t use the local cache of completed builds')
+    parser.add_argument('--stream', dest='stream', action='store_true',
+                        help='print output of commands as it comes (prefixed with branch name)')
+    parser.add_argument('--log-dir', dest='log_dir', metavar="DIR", action='store',
+                        help='write complete output of commands to DIR/<branch>.log')
+    parser.add_argument('--resume', dest='resume', action='store_true',
+                        help='continue the previous (interrupted) run; skip stages of branches '
+                             'that already succeeded')
+    parser.add_argument('--nowait', dest='nowait', action='store_true',
+                        help='submit builds without waiting (with -b, -s) and watch their tasks '
+                             'in one session')
+    parser.add_argument('--follow', dest='follow', action='store_true',
+                        help='wait until launched ansible jobs are finished (with -r)')
+    parser.add_argument('--engine', dest='engine', choices=('threads', 'async'),
+                        help='execution engine (default: threads)')
+    parser.add_argument('--timeout', dest='timeout', metavar="SECONDS", type=float,
+                        help='cancel work of a branch after given time (async engine); '
+                             'limits waiting for repos, watching of build tasks and '
+                             'following of ansible jobs too')
+    parser.add_argument('--metrics-out', dest='metrics_out', metavar="FILE", action='store',
+                        help='write durations of phases and counts of subprocesses and hub calls '
+                             'per branch to FILE (JSON; Prometheus text format for *.prom)')
+    parser.add_argument('--max-workers', dest='max_workers', metavar="N", type=int,
+                        help='number of branches processed at the same time '
+                             '(default: {})'.format(DEFAULT_MAX_WORKERS))
     command_group = parser.add_mutually_exclusive_group(required=True)
     command_group.add_argument('-p', '--print-summary', dest='do_summary', action='store_true',
                                help='prints the summary')
@@ -80,82 +516,170 @@ def prepare_parser():
     command_group.add_argument('-e', '--execute', dest='execute_custom', metavar="COMMAND",
                                action='store',
                                help='executes custom command')
-    command_group.add_argument('-l', '--gather-logs', dest='task_id', metavar="TASK_ID",
-                               action='store',
-                               help='gather build logs and store them locally', type=int)
+    command_group.add_argument('-l', '--gather-logs', dest='task_ids', metavar="TASK_ID",
+                               nargs='+',
+                               help='gather build logs (of all architectures) of the tasks '
+                                    'and store them locally', type=int)
     command_group.add_argument('-w', '--wait-repo', dest='wait_repo', action='store_true',
                                help='will wait for repo regeneration')
+    command_group.add_argument('--pipeline', dest='pipeline', metavar="STAGES",
+                               type=parse_stages,
+                               help='runs comma-separated stages ({}) for each branch; '
+                                    'a branch continues with the next stage as soon as '
+                                    'its previous stage succeeded'.format(
+                                        ",".join(PIPELINE_STAGES)))
     command_group.add_argument('-r', '--regen-rcm-repo', dest='regen_rcm_repo', action='store_true',
                                help='executes rcm repo regeneration')
     return parser
 
 
-def execute_thread_approach(args, config, logger, log_buff):
+def prepare_threads(args, config, logger, log_buff, stages, repo_dir=None, ansible=None):
+    """
+    BuildThreads of branches of the dist-git repo (the current directory by default).
+    Threads of other repos than the current directory are named '<repo>:<branch>'.
+    Returns None when the repo isn't ready.
+    """
+    if repo_dir:
+        config = get_repo_config(config, repo_dir)
+        logger.info("Repo '{}'".format(repo_dir))
+    # threads of the repo share its settings; they don't read the config anymore
+    settings = load_settings(config, ansible, args.timeout)
     branches = get_branches(args, config, logger)
     if not branches:
-        return
-
-    # update config with ansible creadentials.
-    if args.regen_rcm_repo:
-        (ansible_url, ansible_username, ansible_password,
-         ansible_token) = get_ansible_credentials(config)
-        if not (ansible_url and ansible_username and (ansible_password or ansible_token)):
-            return
-        config.set("ansible", "url", ansible_url)
-        config.set("ansible", "username", ansible_username)
-        config.set("ansible", "password", ansible_password)
-        config.set("ansible", "token", ansible_token)
+        return None
+
+    # local problems are found before remote builds fail on them
+    if ((args.do_build or "build" in stages)
+            and not run_preflight(branches, config, logger, repo_dir)):
+        return None
+
+    worktrees = {}
+    if use_worktrees(args, config):
+        # worktrees are prepared serially - git locks its metadata when adding them
+        worktree_root = get_worktree_root(config, repo_dir)
+        logger.info("Using worktrees in '{}'".format(worktree_root))
+        for branch in branches:
+            worktrees[branch] = prepare_worktree(branch, worktree_root, cwd=repo_dir)
+        if not all(worktrees.values()):
+            logger.error("Some worktrees weren't prepared")
+            release_worktrees(worktrees.items())
+            return None
+
+    journal = Journal(get_journal_path(get_journal_kind(args), repo_dir), resume=args.resume)
 
     threads = []
-    distribution = detect_distribution(branches)  # TODO: duplicate functionality?
-    distribution_tool, server_tool = get_distribution_tool(distribution)
+    # threads sharing the repo's directory take turns in switching branches
+    checkout_lock = threading.Lock()
     for i, branch in enumerate(branches):
+        # branches of more distributions (e.g. Fedora and RHEL) can be mixed
+        distribution_tool, __ = get_distribution_tool(detect_distribution(branch))
+        name = "{}:{}".format(os.path.basename(repo_dir), branch) if repo_dir else branch
+        thread_args = dict(workdir=worktrees.get(branch), checkout_lock=checkout_lock,
+                           journal=journal, skip_built=bool(args.do_build or stages),
+                           branch=branch, repo_dir=repo_dir)
         # create new thread
-        if args.do_build:
-            command = ["{} build".format(distribution_tool)]
-            thread = BuildThread(config, log_buff, i, branch, command=command)
+        if args.do_build and args.nowait:
+            command = [distribution_tool, "build", "--nowait"]
+            thread = BuildThread(settings, log_buff, i, name, command=command, mode="submit",
+                                 **thread_args)
+        elif args.do_build:
+            command = [distribution_tool, "build"]
+            thread = BuildThread(settings, log_buff, i, name, command=command, **thread_args)
+        elif args.do_scratch_build and args.nowait:
+            command = [distribution_tool, "scratch-build", "--srpm", "--nowait"]
+            thread = BuildThread(settings, log_buff, i, name, command=command, mode="submit",
+                                 **thread_args)
         elif args.do_scratch_build:
-            command = ["{} scratch-build --srpm".format(distribution_tool)]
-            thread = BuildThread(config, log_buff, i, branch, command=command)
+            command = [distribution_tool, "scratch-build", "--srpm"]
+            thread = BuildThread(settings, log_buff, i, name, command=command, **thread_args)
         elif args.execute_custom:
+            # custom commands keep shell semantics (pipes, variables, ...)
             command = [args.execute_custom]
-            thread = BuildThread(config, log_buff, i, branch, command=command)
+            thread = BuildThread(settings, log_buff, i, name, command=command, shell=True,
+                                 **thread_args)
         elif args.do_tag:
-            thread = BuildThread(config, log_buff, i, branch, mode="tag")
+            thread = BuildThread(settings, log_buff, i, name, mode="tag", **thread_args)
         elif args.do_summary or args.do_jira:
-            thread = BuildThread(config, log_buff, i, branch, mode="summary")
+            thread = BuildThread(settings, log_buff, i, name, mode="summary", **thread_args)
         elif args.wait_repo:
-            thread = BuildThread(config, log_buff, i, branch, mode="wait-repo")
+            thread = BuildThread(settings, log_buff, i, name, mode="wait-repo", **thread_args)
         elif args.regen_rcm_repo:
-            thread = BuildThread(config, log_buff, i, branch, mode="regen-rcm-repo")
+            thread = BuildThread(settings, log_buff, i, name, mode="regen-rcm-repo",
+                                 **thread_args)
+        elif stages:
+            command = [distribution_tool, "build"]
+            thread = BuildThread(settings, log_buff, i, name, command=command, mode="pipeline",
+                                 stages=stages, **thread_args)
 
         threads.append(thread)
+    return threads
 
-        # start new thread
-        thread.start()
-        # delay for safe checkout
-        # TODO: it is also workaround for `verrel`. It needs some time to get correct result
-        # after switching branch
-        time.sleep(3)
 
-    # wait for all threads to complete
-    time.sleep(1)
-    logging.info("waiting ... threads are working")
-    for thread in threads:
-        thread.join()
-    logging.info("threads finished")
+def execute_thread_approach(args, config, logger, log_buff):
+    stages = args.pipeline or []
+    do_jira = args.do_jira or "jira" in stages
+
+    # ansible credentials are resolved once and passed to threads in their settings
+    ansible = None
+    if args.regen_rcm_repo or "regen" in stages:
+        store_path = os.path.join(DEFAULT_CONFIG_PATH, CREDENTIALS_FILE_NAME)
+        ansible = get_ansible_credentials(config, store_path)
+        if not (ansible.url and ansible.username and ansible.token):
+            return
+    settings = load_settings(config, ansible, args.timeout)
 
-    for name in branches:
+    # branches of all repos are processed in one pool sharing one koji session
+    threads = []
+    try:
+        for repo_dir in get_repos(args, config) or [None]:
+            repo_threads = prepare_threads(args, config, logger, log_buff, stages, repo_dir,
+                                           ansible)
+            if repo_threads is None:
+                return
+            threads += repo_threads
+
+        # run threads in the bounded pool and wait for all of them
+        start = time.monotonic()
+        logging.info("waiting ... threads are working")
+        scheduler = get_scheduler(args, config, logger)
+        if args.do_tag or args.do_summary or args.do_jira:
+            prefetch_builds(scheduler, threads)
+        elif args.do_build or "build" in stages:
+            # branches whose builds already exist are skipped
+            prefetch_builds(scheduler, threads, tags=True)
+        if args.wait_repo and settings.native_wait_repo:
+            results = wait_for_repos(scheduler, threads, args.timeout, log_buff)
+        else:
+            results = scheduler.run(threads)
+        logging.info("threads finished in {:.2f} s".format(time.monotonic() - start))
+    finally:
+        release_worktrees([(thread.branch, thread.workdir) for thread in threads])
+
+    if args.nowait and (args.do_build or args.do_scratch_build):
+        results = watch_tasks(threads, results, args.timeout, log_buff)
+
+    regen_jobs = results if args.regen_rcm_repo else {}
+    if stages:
+        regen_jobs = collections.OrderedDict((thread.name, thread.stage_results.get("regen"))
+                                             for thread in threads if "regen" in stages)
+    if args.follow and regen_jobs:
+        follow_regen_jobs(ansible, regen_jobs, args.timeout, log_buff)
+
+    names = [thread.name for thread in threads]
+    for name in names:
         print("========== %s ==========" % name)
         print(ColorFormatter.DIM, end='', flush=True)
-        print("err: " + ''.join(log_buff.get_errors(name)))
-        print("out: " + ''.join(log_buff.get_output(name)))
+        log_buff.print_branch(name)
         print(ColorFormatter.RESET, end='', flush=True)
-    if log_buff.get_output("_summary"):
-        summary = '\n'.join(log_buff.get_output("_summary"))
-        if args.do_jira:
-            builds = '\n'.join(["* {}".format(build) for build in log_buff.get_output("_builds")])
-            tags = ', '.join(log_buff.get_output("_tags"))
+    # summary records in order of branches; builds of branches skipped by '-b' too
+    records = log_buff.get_records(names)
+    if records:
+        summary = '\n'.join(["[{nvr}|{url}]".format(**record) for record in records])
+        if do_jira:
+            builds = '\n'.join(["* {}".format(record["nvr"]) for record in records])
+            # packages of more repos share tags
+            tags = ', '.join(collections.OrderedDict.fromkeys(record["tag"]
+                                                              for record in records))
             print("JIRA template:")
             jira_template = (dedent("""
                              Project: RCM
@@ -176,29 +700,19 @@ def execute_thread_approach(args, config, logger, log_buff):
         else:
             print("Available builds summary:")
             print(summary)
+    run_metrics.print_table()
 
 
 def execute_simple_approach(args, config, logger, log_buff):
     # so far there is only one functionality - gathering logs
-    out, __, __ = execute_command(
-        "get_subtask",
-        ["brew call --json getTaskChildren {}".format(args.task_id)],
-        ["jq '.[] | select(.method==\"buildArch\") | .id'"]
-    )
-    task_id = out.strip() or args.task_id
-    try:
-        int(task_id)
-    except ValueError:
-        logger.error("Task_id is not valid: {}".format(task_id))
-        return
-    out, err, ret = execute_command("gather_logs", "brew download-logs {}".format(task_id))
-    if ret:
-        logger.error("During gathering or saving logs")
+    max_workers = args.max_workers or get_max_workers(config, "general", DEFAULT_MAX_WORKERS)
+    downloader = LogDownloader("brew", max_workers=max_workers)
+    failed = downloader.gather(args.task_ids)
+    if failed:
+        logger.error("During gathering or saving logs:\n{}".format("\n".join(failed)))
     else:
         logger.info("Logs were gathered and saved:")
-    if err:
-        logger.error(err)
-    print("===", out, "===")
+    print("===", os.path.abspath(downloader.logs_dir), "===")
 
 
 def main():
@@ -229,13 +743,24 @@ def main():
         if not files:
             logger.warning("Config file '%s' is missing." % config_file2)
 
-    log_buff = LogBuffer()
+    log_buff = prepare_log_buffer(args, config, logger)
+    # extra branch patterns, tools, ... from the [distributions] section
+    BranchResolver.configure(config)
+
+    if not args.no_cache:
+        Kojiwrapper.cache = get_build_cache(config, logger)
 
-    if args.task_id:
+    if args.task_ids:
         execute_simple_approach(args, config, logger, log_buff)
     else:
         execute_thread_approach(args, config, logger, log_buff)
 
+    log_buff.close()
+    if Kojiwrapper.cache:
+        Kojiwrapper.cache.save()
+    if args.metrics_out:
+        run_metrics.write(os.path.expanduser(args.metrics_out))
+
     return
 
 
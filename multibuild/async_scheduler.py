@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import collections
+import logging
+
+from .build_thread import CHECKOUT_COMMAND
+from .metrics import current_branch
+from .scheduler import DEFAULT_MAX_WORKERS, Scheduler
+from .tools import execute_command_async
+
+# seconds between attempts to take the checkout lock of the repo
+CHECKOUT_POLL_INTERVAL = 0.01
+
+
+class AsyncScheduler(Scheduler):
+    """
+    Runs work of BuildThreads as asyncio coroutines. Commands waiting for the build
+    system (build, scratch-build, custom command, wait-repo) are awaited subprocesses;
+    the other modes (koji and ansible calls) run in the default executor.
+    """
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS, tool_limits=None, priority=None,
+                 timeout=None):
+        """
+        timeout: seconds after which the branch's work is cancelled
+        """
+        Scheduler.__init__(self, max_workers, priority=priority)
+        self.tool_limits = {tool: limit for tool, limit in (tool_limits or {}).items() if limit}
+        self.timeout = timeout
+
+    def run(self, threads, task=None):
+        """
+        Run all threads (or the task for each of them) and wait for them.
+        Returns results per branch in the original order of threads.
+        """
+        logger = logging.getLogger("scheduler")
+        logger.debug("Running {} branches in {} coroutines".format(len(threads),
+                                                                   self.max_workers))
+        results = asyncio.run(self.run_all(self.order(threads), task))
+        return collections.OrderedDict((thread.name, results[thread.name]) for thread in threads)
+
+    async def run_all(self, threads, task):
+        # asyncio primitives have to be created in the running loop
+        self.workers = asyncio.Semaphore(self.max_workers)
+        self.tool_semaphores = {tool: asyncio.Semaphore(limit)
+                                for tool, limit in self.tool_limits.items()}
+        results = await asyncio.gather(*[self.run_branch(thread, task) for thread in threads])
+        return dict(zip([thread.name for thread in threads], results))
+
+    async def run_branch(self, thread, task):
+        logger = logging.getLogger("scheduler")
+        # each coroutine runs in its own context; executor threads inherit it
+        current_branch.set(thread.name)
+        async with self.workers:
+            semaphore = self.tool_semaphores.get(thread.server_tool)
+            try:
+                if semaphore:
+                    async with semaphore:
+                        return await asyncio.wait_for(self.process(thread, task), self.timeout)
+                return await asyncio.wait_for(self.process(thread, task), self.timeout)
+            except asyncio.TimeoutError:
+                logger.error("Thread '{}' timed out after {} s".format(thread.name,
+                                                                       self.timeout))
+            except Exception as e:
+                logger.error("Thread '{}' failed: {}".format(thread.name, e))
+        return None
+
+    async def process(self, thread, task):
+        if task:
+            return await asyncio.to_thread(task, thread)
+        if thread.mode is None:
+            thread.result = await self.run_stage(thread, thread.command_stage(),
+                                                 lambda: self.run_build(thread))
+        elif thread.mode == "wait-repo":
+            thread.result = await self.run_stage(thread, "wait-repo",
+                                                 lambda: self.wait_repo(thread))
+        else:
+            thread.result = await asyncio.to_thread(thread.run)
+        return thread.result
+
+    async def run_stage(self, thread, stage, coroutine_function):
+        """
+        async variant of BuildThread.run_stage; the stage is journaled and skipped
+        when it already succeeded in the resumed run
+        """
+        entry = await asyncio.to_thread(thread.completed_stage, stage)
+        if entry:
+            return thread.finish_stage(stage, entry.get("result"), resumed=True)
+        result = await coroutine_function()
+        return await asyncio.to_thread(thread.finish_stage, stage, result)
+
+    async def run_build(self, thread):
+        """
+        async variant of BuildThread.run_build; a build command is skipped when
+        the NVR already exists
+        """
+        state, bdata = await asyncio.to_thread(thread.skip_build)
+        if not state:
+            ret = await self.run_standard(thread)
+            thread.forget_build()
+            return ret
+        return await asyncio.to_thread(thread.finish_existing, state, bdata)
+
+    async def run_standard(self, thread):
+        """
+        async variant of BuildThread.run_standard (including its checkout)
+        """
+        if thread.workdir:
+            return await self.execute_standard(thread)
+
+        # the same lock 'verrel' takes in the executor (BuildThread.command_nvr);
+        # it is polled, so no executor thread is blocked by waiting for it
+        if thread.checkout_lock:
+            with thread.phase("waiting for checkout"):
+                while not thread.checkout_lock.acquire(blocking=False):
+                    await asyncio.sleep(CHECKOUT_POLL_INTERVAL)
+            thread.checkout_locked = True
+        try:
+            with thread.phase("checkout"):
+                out, err, ret = await execute_command_async(
+                    thread.name, CHECKOUT_COMMAND + [thread.branch], cwd=thread.repo_dir,
+                    timeout=thread.command_timeout("checkout"))
+            thread.log_buff.append_output(thread.name, out)
+            thread.log_buff.append_error(thread.name, err)
+            if ret:
+                return None
+            # see BuildThread.early_release
+            return await self.execute_standard(thread, thread.early_release())
+        finally:
+            thread.release_checkout()
+
+    async def execute_standard(self, thread, started=None):
+        with thread.phase("command"):
+            out, err, ret = await execute_command_async(
+                thread.name, thread.command, cwd=thread.directory, started=started,
+                on_line=thread.log_buff.line_handler(thread.name), shell=thread.shell,
+                timeout=thread.command_timeout("command"))
+        thread.log_buff.append_output(thread.name, out)
+        thread.log_buff.append_error(thread.name, err)
+        return ret
+
+    async def wait_repo(self, thread):
+        """
+        async variant of BuildThread.wait_repo
+        """
+        verrel = thread.verrel or await asyncio.to_thread(thread.resolve_nvr)
+        if not verrel:
+            return None
+        command = [thread.server_tool, "wait-repo", "--build={}".format(verrel),
+                   "{}-build".format(thread.branch)]
+        out, err, ret = await execute_command_async(
+            thread.name, command, cwd=thread.directory,
+            on_line=thread.log_buff.line_handler(thread.name),
+            timeout=thread.command_timeout("wait-repo"))
+        thread.log_buff.append_output(thread.name, out)
+        thread.log_buff.append_error(thread.name, err)
+        return ret
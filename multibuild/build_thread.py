@@ -1,77 +1,258 @@
 # -*- coding: utf-8 -*-
 
-import configparser
+import contextlib
 import logging
+import re
 import threading
+import time
 
-from .kojiwrapper import Kojiwrapper
+from .kojiwrapper import Kojiwrapper, build_state_name
+from .metrics import run_metrics
+from .nvr import nvr_from_spec
+from .repowaiter import RepoWaiter
+from .settings import BUILD_INFO_URL_TEMPLATE
+from .taskwatcher import DEFAULT_TIMEOUT as WATCH_TIMEOUT, TaskWatcher
 from .tools import (detect_distribution, execute_command,
                     get_distribution_tool, run_ansible_job)
 
-BUILD_INFO_URL_TEMPLATE = "https://brewweb.engineering.redhat.com/brew/buildinfo?buildID=%d"
+# rhpkg/fedpkg prints this after the build was submitted
+TASK_ID_PATTERN = re.compile(r"^Created task: (\d+)", re.MULTILINE)
+
+# switches the shared checkout; branches left in cached worktrees (e.g. by an interrupted
+# run with worktrees) don't block it
+CHECKOUT_COMMAND = ["git", "checkout", "--ignore-other-worktrees"]
+
+# stages of the pipeline mode in their natural order
+PIPELINE_STAGES = ("build", "tag", "wait-repo", "regen", "summary", "jira")
 
 
 class BuildThread(threading.Thread):
-    def __init__(self, config, log_buff, thread_id, name, command=None, mode=None):
+    def __init__(self, settings, log_buff, thread_id, name, command=None, mode=None, workdir=None,
+                 checkout_lock=None, stages=None, journal=None, shell=False, skip_built=False,
+                 branch=None, repo_dir=None):
         threading.Thread.__init__(self)
-        self.config = config
+        # Settings of the run (see 'load_settings'); shared by all threads
+        self.settings = settings
         self.thread_id = thread_id
+        # unique name of the thread; it is the branch unless more repos are processed
         self.name = name
+        self.branch = branch or name
+        # directory of the dist-git repo; None means the current directory
+        self.repo_dir = repo_dir
+        # argv of the command; custom commands are executed by shell
         self.command = command
+        self.shell = shell
         self.mode = mode
         self.log_buff = log_buff
+        # branch's own worktree; None means the shared checkout of the repo
+        self.workdir = workdir
+        # where commands of the branch are executed
+        self.directory = workdir or repo_dir
+        # shared by threads switching branches in the current directory; it is held
+        # from "git checkout" until the branch's working tree was read
+        self.checkout_lock = checkout_lock
+        self.checkout_locked = False
+        # outcome of the thread's mode; see 'run'
+        self.result = None
+        # NVR resolved in advance by 'resolve_nvr'
+        self.verrel = None
+        # stages of the pipeline mode and their results
+        self.stages = stages or []
+        self.stage_results = {}
+        # Journal of the run; None when the run isn't journaled
+        self.journal = journal
+        # the build command is skipped when the branch's NVR already exists
+        self.skip_built = skip_built
 
-        self.distribution = detect_distribution(self.name)
+        self.distribution = detect_distribution(self.branch)
         self.distribution_tool, self.server_tool = get_distribution_tool(self.distribution)
 
     def run(self):
+        """
+        Process the branch according to the mode.
+        Returns (and stores in 'result') the mode's outcome - return code of the command,
+        summary record or ansible job ID. None means the branch failed before.
+        """
         logger = logging.getLogger("run")
         logger.info("Starting thread '{}'".format(self.name))
         if self.mode == "tag":
-            self.run_tag()
+            self.result = self.run_stage("tag", self.run_tag)
         elif self.mode == "summary":
-            self.run_summary()
+            self.result = self.run_stage("summary", self.run_summary)
         elif self.mode == "wait-repo":
-            self.wait_repo()
+            self.result = self.run_stage("wait-repo", self.wait_repo)
         elif self.mode == "regen-rcm-repo":
-            self.regen_rcm_repo()
+            self.result = self.run_stage("regen", self.regen_rcm_repo)
+        elif self.mode == "submit":
+            self.result = self.run_stage("submit " + self.command_stage(), self.run_submit)
+        elif self.mode == "pipeline":
+            self.result = self.run_pipeline()
         else:
-            self.run_standard()
+            self.result = self.run_stage(self.command_stage(), self.run_build)
         logger.info("Exiting thread '{}'".format(self.name))
+        return self.result
+
+    @staticmethod
+    def stage_succeeded(stage, result):
+        """
+        commands succeed with zero return code; other stages with a result (record, ID)
+        """
+        if stage in ("regen", "summary", "jira") or stage.startswith("submit "):
+            return bool(result)
+        return result == 0
+
+    def run_stage(self, stage, method):
+        """
+        Run the stage's method and record its result in the journal.
+        The stage is skipped when it already succeeded in the resumed run.
+        """
+        entry = self.completed_stage(stage)
+        if entry:
+            return self.finish_stage(stage, entry.get("result"), resumed=True)
+        return self.finish_stage(stage, method())
+
+    def command_stage(self):
+        """name of the command's stage in the journal"""
+        return " ".join(self.command)
+
+    def completed_stage(self, stage):
+        """
+        journal entry of the stage when it already succeeded in the resumed run, otherwise None.
+        Entries of another NVR than the branch has now (new commits since then) are ignored.
+        """
+        logger = logging.getLogger("run_stage")
+        entry = self.journal and self.journal.get_completed(self.name, stage)
+        if not entry:
+            return None
+        if entry.get("nvr"):
+            verrel = self.verrel or self.resolve_nvr()
+            if verrel != entry["nvr"]:
+                logger.info("'{}' {}: done for '{}' in the resumed run, now it is '{}'".format(
+                    self.name, stage, entry["nvr"], verrel))
+                return None
+        logger.info("'{}' {}: already done in the resumed run".format(self.name, stage))
+        return entry
+
+    def finish_stage(self, stage, result, resumed=False):
+        """
+        record result of the stage in the journal (unless it is a result of the resumed run)
+        and pass summary records on; returns the result
+        """
+        if self.journal and not resumed:
+            task_id = result if stage.startswith("submit ") else None
+            self.journal.record(self.name, stage, result, self.stage_succeeded(stage, result),
+                                nvr=self.verrel, task_id=task_id)
+        if stage in ("summary", "jira"):
+            self.store_record(result)
+        return result
+
+    def store_record(self, record):
+        """summary record of the branch's build goes to the summary and JIRA template"""
+        if isinstance(record, dict):
+            self.log_buff.add_record(self.name, record)
+
+    def command_timeout(self, command_name):
+        """
+        timeout (seconds) of the command from [timeouts] section; None means no limit
+        """
+        return self.settings.timeouts.get(command_name)
+
+    @contextlib.contextmanager
+    def phase(self, phase_name):
+        """
+        measure and log duration of the thread's phase; it is recorded in the run's metrics
+        """
+        logger = logging.getLogger("phase")
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            duration = time.monotonic() - start
+            run_metrics.add_phase(phase_name, duration, self.name)
+            logger.info("'{}' {}: {:.2f} s".format(self.name, phase_name, duration))
+
+    def release_checkout(self):
+        """
+        the branch's working tree won't be read anymore - other threads can switch branches
+        """
+        if self.checkout_locked:
+            self.checkout_locked = False
+            self.checkout_lock.release()
+
+    def early_release(self):
+        """
+        'release_checkout' when the command reads the branch's working tree just before its
+        first line - 'build' takes the pushed commit. Otherwise None: custom commands and
+        scratch builds (SRPM is made from the tree) keep the checkout until they finish.
+        """
+        if not self.shell and self.command[1:2] == ["build"]:
+            return self.release_checkout
+        return None
 
     def checkout(func):
         """
         decorator function - it executes "git checkout <branch>"
-        and if sucessfull, it continues in decorated function
+        and if sucessfull, it continues in decorated function.
+        The branch's worktree is already checked out.
+        Checkout lock stays acquired until decorated function calls 'release_checkout'.
         """
         def run_checkout(self):
-            out, err, ret = execute_command(self.name, ["git checkout {}".format(self.name)])
-            self.log_buff.append_output(self.name, out)
-            self.log_buff.append_error(self.name, err)
-            if ret == 0:
-                func(self)
+            if self.workdir:
+                return func(self)
+            if self.checkout_lock:
+                with self.phase("waiting for checkout"):
+                    self.checkout_lock.acquire()
+                self.checkout_locked = True
+            try:
+                with self.phase("checkout"):
+                    out, err, ret = execute_command(self.name, CHECKOUT_COMMAND + [self.branch],
+                                                    cwd=self.repo_dir,
+                                                    timeout=self.command_timeout("checkout"))
+                self.log_buff.append_output(self.name, out)
+                self.log_buff.append_error(self.name, err)
+                if ret == 0:
+                    return func(self)
+            finally:
+                self.release_checkout()
         return run_checkout
 
     def local_nvr(self):
         """
-        load nvr from config data (depends on project) or by rhpkg/fedpkg command
+        load nvr from the branch's spec file (in format from config; depends on project)
+        or by rhpkg/fedpkg command
         """
-        nvr_format = None
-        try:
-            nvr_format = self.config.get("nvr", "format")
-            # TODO: process data from config
-        except (configparser.NoOptionError, configparser.NoSectionError):
-            pass
-
-        if not nvr_format:
-            # get local nvr by executing "rhpkg/fedpkg verrel"
-            out, err, __ = execute_command(self.name, ["{} verrel".format(self.distribution_tool)])
-            self.log_buff.append_output(self.name, out)
-            self.log_buff.append_error(self.name, err)
-            if out:
-                return out.strip()
+        if self.settings.native_nvr:
+            with self.phase("native verrel"):
+                verrel = nvr_from_spec(self.branch, self.settings.nvr_format,
+                                       cwd=self.directory)
+            if verrel:
+                return verrel
+        return self.command_nvr()
+
+    @checkout
+    def command_nvr(self):
+        """
+        get local nvr by executing "rhpkg/fedpkg verrel"
+        """
+        command = [self.distribution_tool, "verrel"]
+        with self.phase("verrel"):
+            out, err, __ = execute_command(self.name, command, cwd=self.directory,
+                                           timeout=self.command_timeout("verrel"))
+        self.release_checkout()
+        self.log_buff.append_output(self.name, out)
+        self.log_buff.append_error(self.name, err)
+        if out:
+            return out.strip()
         return None
 
+    def resolve_nvr(self):
+        """
+        Find out the branch's NVR. It is stored for the later run
+        so NVRs of all branches can be looked up in koji at once.
+        """
+        self.verrel = self.local_nvr()
+        return self.verrel
+
     @checkout
     def run_standard(self):
         """
@@ -80,81 +261,194 @@ class BuildThread(threading.Thread):
         """
         logger = logging.getLogger("run_standard")
         logger.debug("'{}'".format(self.command))
-        out, err, __ = execute_command(self.name, self.command)
+        with self.phase("command"):
+            out, err, ret = execute_command(self.name, self.command, cwd=self.directory,
+                                            started=self.early_release(),
+                                            on_line=self.log_buff.line_handler(self.name),
+                                            shell=self.shell,
+                                            timeout=self.command_timeout("command"))
         self.log_buff.append_output(self.name, out)
         self.log_buff.append_error(self.name, err)
+        return ret
+
+    def existing_build(self):
+        """
+        (state name, build data) when the build of the branch's NVR already exists
+        (it is complete or still building) - the build command would fail.
+        Otherwise (None, None).
+        """
+        logger = logging.getLogger("existing_build")
+        verrel = self.verrel or self.resolve_nvr()
+        if not verrel:
+            return None, None
+        try:
+            with self.phase("koji lookup"):
+                bdata = Kojiwrapper.get_instance(self.server_tool).get_build(verrel)
+        except Exception as e:
+            # unknown build; the build is submitted
+            logger.debug("get_build: {}".format(e))
+            return None, None
+        state = build_state_name(bdata) if bdata else None
+        if state not in ("COMPLETE", "BUILDING"):
+            return None, None
+        return state, bdata
+
+    def skip_build(self):
+        """
+        Skip the build when the branch's NVR already exists (with 'skip_built').
+        The existing build goes to the summary. Returns (state name, build data)
+        of the skipped build or (None, None).
+        """
+        logger = logging.getLogger("skip_build")
+        if not self.skip_built:
+            return None, None
+        state, bdata = self.existing_build()
+        if not state:
+            return None, None
+        status = "'{}' is already built ({})".format(self.verrel, state)
+        try:
+            tags = Kojiwrapper.get_instance(self.server_tool).get_tags(self.verrel)
+            if tags:
+                status += ", tagged in: {}".format(", ".join(tags))
+        except Exception as e:
+            logger.error("get_tags: {}".format(e))
+        logger.info("'{}': {}. Skipping the build".format(self.name, status))
+        self.log_buff.append_output(self.name, "{}. The build was skipped.".format(status))
+        if state == "COMPLETE":
+            self.store_record(self.run_summary())
+        return state, bdata
+
+    def forget_build(self):
+        """
+        The build looked up before it was submitted was unknown; later stages
+        have to look it up again.
+        """
+        if self.skip_built and self.verrel:
+            Kojiwrapper.get_instance(self.server_tool).forget_build(self.verrel)
+
+    def run_build(self):
+        """
+        Run the command; a build command is skipped when the NVR already exists.
+        A build that is still running is waited for instead.
+        """
+        state, bdata = self.skip_build()
+        if not state:
+            ret = self.run_standard()
+            self.forget_build()
+            return ret
+        return self.finish_existing(state, bdata)
+
+    def finish_existing(self, state, bdata):
+        """
+        result of the skipped build command - the existing build is complete
+        or it is waited for
+        """
+        if state == "COMPLETE":
+            return 0
+        watcher = TaskWatcher(Kojiwrapper.get_instance(self.server_tool),
+                              timeout=self.command_timeout("watch") or WATCH_TIMEOUT)
+        states = watcher.watch({self.name: bdata.get("task_id")})
+        return 0 if states[self.name] == "CLOSED" else 1
+
+    def run_submit(self):
+        """
+        Submit the build without waiting for it (the command has '--nowait' option).
+        Returns ID of the created task or None. Task of the existing build is returned
+        when the build is skipped.
+        """
+        logger = logging.getLogger("run_submit")
+        state, bdata = self.skip_build()
+        if state:
+            return bdata.get("task_id")
+        ret = self.run_standard()
+        self.forget_build()
+        if ret != 0:
+            return None
+        match = TASK_ID_PATTERN.search("\n".join(self.log_buff.get_output(self.name)))
+        if not match:
+            logger.error("Task ID wasn't found in output of '{}'".format(self.name))
+            return None
+        return int(match.group(1))
 
-    @checkout
     def run_tag(self):
         """
         """
         logger = logging.getLogger("run_tag")
 
-        verrel = self.local_nvr()
+        verrel = self.verrel or self.resolve_nvr()
         if verrel:
             # find out whether proper build in koji is prepared already
-            koji = Kojiwrapper(self.server_tool)
+            koji = Kojiwrapper.get_instance(self.server_tool)
             koji_result = None
             try:
-                koji_result = koji.get_build(verrel)
+                with self.phase("koji lookup"):
+                    koji_result = koji.get_build(verrel)
             except Exception as e:
                 logger.error("get_build: {}".format(e))
 
             # local build matches koji build
             if koji_result and koji_result.get("nvr", "") == verrel:
+                # tags are known when they were prefetched
+                if self.branch in koji.tags.get(verrel, []):
+                    message = "'{}' is already tagged in '{}'".format(verrel, self.branch)
+                    logger.info(message)
+                    self.log_buff.append_output(self.name, message)
+                    return 0
                 # tag the build
-                command = "brew tag-build {} {}".format(self.name, verrel)
-                logger.debug("'{}'".format(self.command))
-                out, err, ret = execute_command(self.name, [command])
+                command = ["brew", "tag-build", self.branch, verrel]
+                with self.phase("tag"):
+                    out, err, ret = execute_command(self.name, command, cwd=self.directory,
+                                                    timeout=self.command_timeout("tag"))
                 self.log_buff.append_output(self.name, out)
                 self.log_buff.append_error(self.name, err)
                 if not ret:
                     waitrepo_cmd = "brew wait-repo {branch}-build --build={nvr}"
-                    waitrepo_cmd = waitrepo_cmd.format(branch=self.name, nvr=verrel)
+                    waitrepo_cmd = waitrepo_cmd.format(branch=self.branch, nvr=verrel)
                     message = "\nYou can wait for repo regeneration by executing command:\n  {}"
                     message = message.format(waitrepo_cmd)
                     self.log_buff.append_output(self.name, message)
+                return ret
             else:
                 message = "koji nvr '{}' do not match with {} verrel '{}'"
-                message = message.format(koji_result.get("nvr", ""), self.distribution_tool, verrel)
+                message = message.format((koji_result or {}).get("nvr", ""),
+                                         self.distribution_tool, verrel)
                 logger.error(message)
 
-    @checkout
     def run_summary(self):
         """
+        Returns summary record of the branch's build:
+        {"nvr": ..., "build_id": ..., "url": ..., "tag": ..., "durations": {phase: seconds}}
         """
         logger = logging.getLogger("run_summary")
 
-        verrel = self.local_nvr()
+        verrel = self.verrel or self.resolve_nvr()
         if verrel:
             # find out whether proper build in koji is prepared already
-            koji = Kojiwrapper(self.server_tool)
+            koji = Kojiwrapper.get_instance(self.server_tool)
             koji_result = None
             try:
-                koji_result = koji.get_build(verrel)
+                with self.phase("koji lookup"):
+                    koji_result = koji.get_build(verrel)
             except Exception as e:
                 logger.error("get_build: {}".format(e))
 
             # find out 'build_id' in koji results
             if koji_result and koji_result.get("build_id"):
-                try:
-                    build_info_url_template = self.config.get(self.server_tool,
-                                                              "build_info_url_template")
-                except (configparser.NoOptionError, configparser.NoSectionError):
-                    logger.warning("config lacks 'build_info_url_template' value. Using default")
-                    build_info_url_template = BUILD_INFO_URL_TEMPLATE
+                build_info_url_template = self.settings.build_info_url_templates.get(
+                    self.server_tool, BUILD_INFO_URL_TEMPLATE)
                 if build_info_url_template:
                     # compose build_info_url from url template and build_id
                     build_info_url = build_info_url_template % koji_result.get("build_id")
-                    stream = "[{verrel}|{url}]".format(verrel=verrel, url=build_info_url)
-                    # common output for all threads
-                    self.log_buff.append_output("_summary", stream)
-                    self.log_buff.append_output("_builds", verrel)
-                    self.log_buff.append_output("_tags", self.name)
+                    return {
+                        "nvr": verrel,
+                        "build_id": koji_result.get("build_id"),
+                        "url": build_info_url,
+                        "tag": self.branch,
+                        "durations": run_metrics.branch_seconds(self.name),
+                    }
             else:
                 logger.error("build_id wasn't found for '{}'".format(verrel))
 
-    @checkout
     def wait_repo(self):
         """
         Wait for regeneration of the repository with latest build
@@ -162,17 +456,61 @@ class BuildThread(threading.Thread):
         """
         logger = logging.getLogger("wait-repo")
 
-        verrel = self.local_nvr()
+        verrel = self.verrel or self.resolve_nvr()
         if verrel:
-            command = "{server_tool} wait-repo --build={verrel} {name}-build"
-            command = command.format(server_tool=self.server_tool, verrel=verrel, name=self.name)
-            logger.debug("'{}'".format(command))
+            command = [self.server_tool, "wait-repo", "--build={}".format(verrel),
+                       "{}-build".format(self.branch)]
             logger.warning("Method is not checking whether build is already tagged")  # FIXME
-            out, err, __ = execute_command(self.name, command)
+            with self.phase("wait-repo"):
+                out, err, ret = execute_command(self.name, command, cwd=self.directory,
+                                                on_line=self.log_buff.line_handler(self.name),
+                                                timeout=self.command_timeout("wait-repo"))
             self.log_buff.append_output(self.name, out)
             self.log_buff.append_error(self.name, err)
+            return ret
+
+    def wait_repo_stage(self):
+        """
+        wait for the repo in the pipeline; other branches share the koji session
+        """
+        if not self.settings.native_wait_repo:
+            return self.wait_repo()
+        verrel = self.verrel or self.resolve_nvr()
+        if verrel:
+            tag = "{}-build".format(self.branch)
+            with self.phase("wait-repo"):
+                waiter = RepoWaiter(Kojiwrapper.get_instance(self.server_tool))
+                ready = waiter.wait({tag: verrel})
+            return 0 if ready[tag] else 1
+        return None
+
+    def run_pipeline(self):
+        """
+        Run the stages one after another; each of them as soon as the previous one succeeded.
+        NVR and build data are resolved once and reused by all stages.
+        Returns result of the last stage or None when some stage failed.
+        """
+        logger = logging.getLogger("run_pipeline")
+        methods = {
+            "build": self.run_build,
+            "tag": self.run_tag,
+            "wait-repo": self.wait_repo_stage,
+            "regen": self.regen_rcm_repo,
+            "summary": self.run_summary,
+            "jira": self.run_summary,
+        }
+        result = None
+        for stage in self.stages:
+            logger.info("'{}' stage: {}".format(self.name, stage))
+            with self.phase("stage {}".format(stage)):
+                result = self.run_stage(stage, methods[stage])
+            self.stage_results[stage] = result
+            if not self.stage_succeeded(stage, result):
+                message = "'{}' stage {} failed. Skipping the next stages"
+                logger.error(message.format(self.name, stage))
+                return None
+        return result
 
-    @checkout
     def regen_rcm_repo(self):
         """
         more about Ansible authentiacation:
@@ -180,16 +518,13 @@ class BuildThread(threading.Thread):
         """
         logger = logging.getLogger("regen-rcm-repo")
 
-        # read credentials from config.
-        # Parent method updated this config if the information wasn't there yet.
-        baseurl = self.config.get("ansible", "url")
-        username = self.config.get("ansible", "username")
-        password = self.config.get("ansible", "password")
-        token = self.config.get("ansible", "token")
+        # credentials were entered (or read from config) before threads were started
+        baseurl, username, password, token = self.settings.ansible
 
-        verrel = self.local_nvr()
+        verrel = self.verrel or self.resolve_nvr()
         logger.debug("'{}'".format(verrel))
-        job_id = run_ansible_job(baseurl, username, password, token, self.name, verrel)
+        with self.phase("ansible launch"):
+            job_id = run_ansible_job(baseurl, username, password, token, self.branch, verrel)
         if job_id:
             self.log_buff.append_output(self.name,
                                         "job url: {}/#/jobs/playbook/{}".format(baseurl, job_id))
@@ -198,3 +533,4 @@ class BuildThread(threading.Thread):
         err = ""
         self.log_buff.append_output(self.name, out)
         self.log_buff.append_error(self.name, err)
+        return job_id
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import os
+import threading
+import time
+
+DEFAULT_TTL = 30 * 24 * 3600  # seconds
+DEFAULT_MAX_ENTRIES = 5000
+
+
+class BuildCache(object):
+    """
+    Persistent cache of build data (JSON file) keyed by koji profile and N-V-R.
+    Only completed builds are stored - they don't change in koji anymore.
+    Entries older than 'ttl' are dropped; the oldest ones are dropped when there
+    are more than 'max_entries' of them.
+    """
+    def __init__(self, path, ttl=DEFAULT_TTL, max_entries=DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = None
+        self.changed = False
+
+    @staticmethod
+    def key(profile, nvr):
+        return "{}:{}".format(profile, nvr)
+
+    def load(self):
+        """
+        read the cache file; call it with the lock held
+        """
+        logger = logging.getLogger("build_cache")
+        self.entries = {}
+        if not os.path.isfile(self.path):
+            return
+        try:
+            with open(self.path) as cache_file:
+                self.entries = json.load(cache_file)
+        except (OSError, ValueError) as e:
+            logger.warning("Build cache '{}' wasn't loaded: {}".format(self.path, e))
+            return
+        self.evict()
+
+    def evict(self):
+        now = time.time()
+        expired = [key for key, entry in self.entries.items()
+                   if now - entry.get("time", 0) > self.ttl]
+        for key in expired:
+            del self.entries[key]
+        overflow = len(self.entries) - self.max_entries
+        if overflow > 0:
+            oldest = sorted(self.entries, key=lambda key: self.entries[key].get("time", 0))
+            for key in oldest[:overflow]:
+                del self.entries[key]
+        if expired or overflow > 0:
+            self.changed = True
+
+    def get(self, profile, nvr):
+        """
+        cached build data or None
+        """
+        with self.lock:
+            if self.entries is None:
+                self.load()
+            entry = self.entries.get(self.key(profile, nvr))
+        return entry and entry.get("build")
+
+    def put(self, profile, nvr, build):
+        with self.lock:
+            if self.entries is None:
+                self.load()
+            self.entries[self.key(profile, nvr)] = {"time": time.time(), "build": build}
+            self.changed = True
+
+    def save(self):
+        """
+        write the cache file if something changed
+        """
+        logger = logging.getLogger("build_cache")
+        with self.lock:
+            if not self.changed:
+                return
+            self.evict()
+            tmp_path = "{}.tmp".format(self.path)
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                with open(tmp_path, "w") as cache_file:
+                    json.dump(self.entries, cache_file)
+                os.replace(tmp_path, self.path)
+            except OSError as e:
+                logger.warning("Build cache '{}' wasn't saved: {}".format(self.path, e))
+                return
+            self.changed = False
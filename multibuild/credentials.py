@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+
+import configparser
+import getpass
+import json
+import logging
+import os
+import stat
+import sys
+import threading
+import time
+
+from .settings import AnsibleCredentials
+from .tools import create_ansible_token
+
+ENV_PREFIX = "MULTIBUILD_ANSIBLE_"
+# cached tokens expiring sooner (seconds) are not used
+TOKEN_EXPIRY_MARGIN = 5 * 60
+
+# credentials resolved by the first call of 'get_ansible_credentials'
+_credentials = None
+_credentials_lock = threading.Lock()
+
+
+def env_credentials(found, config):
+    """MULTIBUILD_ANSIBLE_URL, _USERNAME, _TOKEN and _PASSWORD environment variables"""
+    return {field: os.environ.get(ENV_PREFIX + field.upper())
+            for field in AnsibleCredentials._fields}
+
+
+def config_credentials(found, config):
+    """values of [ansible] section"""
+    values = {}
+    for field in AnsibleCredentials._fields:
+        try:
+            values[field] = config.get("ansible", field)
+        except (configparser.NoOptionError, configparser.NoSectionError):
+            pass
+    return values
+
+
+def prompt_credentials(found, config):
+    """ask the user for the missing values; only when multibuild runs in a terminal"""
+    logger = logging.getLogger("get_ansible_credentials")
+    if not sys.stdin.isatty():
+        return {}
+    values = {}
+    if not found.get("url"):
+        values["url"] = input("Ansible url (ansible host): ")
+    if not found.get("username"):
+        values["username"] = input("Ansible username: ")
+    if not (found.get("token") or found.get("password")):
+        values["token"] = input("Ansible token: ")
+        if not values["token"]:
+            try:
+                values["password"] = getpass.getpass()
+            except Exception as e:
+                logger.error("Ansible password error: %s" % e)
+    return values
+
+
+class CredentialStore(object):
+    """
+    Credentials and cached tokens in a JSON file accessible just by the user (0600):
+    {"<ansible url>": {"username": ..., "password": ..., "token": ..., "expires": ...}}
+    'expires' is timestamp of the token's expiration. The file is ignored when
+    other users can access it.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        """entries of the store; None when the store can't be used"""
+        logger = logging.getLogger("credential_store")
+        try:
+            mode = os.stat(self.path).st_mode
+        except FileNotFoundError:
+            return {}
+        if mode & (stat.S_IRWXG | stat.S_IRWXO):
+            logger.warning("Credential store '{}' is accessible by other users; it is ignored "
+                           "(use 'chmod 600')".format(self.path))
+            return None
+        try:
+            with open(self.path) as store_file:
+                entries = json.load(store_file)
+        except (OSError, ValueError) as e:
+            logger.warning("Credential store '{}' can't be read: {}".format(self.path, e))
+            return None
+        return entries if isinstance(entries, dict) else None
+
+    def credentials(self, found, config):
+        """
+        entry of the ansible url; the only entry is used when the url isn't known yet.
+        Expired tokens are left out.
+        """
+        logger = logging.getLogger("credential_store")
+        entries = self.load() or {}
+        url = found.get("url")
+        if not url and len(entries) == 1:
+            url = next(iter(entries))
+        entry = dict(entries.get(url) or {})
+        if not entry:
+            return {}
+        expires = entry.pop("expires", None)
+        if entry.get("token") and expires and expires < time.time() + TOKEN_EXPIRY_MARGIN:
+            logger.info("Cached ansible token has expired")
+            del entry["token"]
+        entry["url"] = url
+        return entry
+
+    def save_token(self, url, username, token, expires):
+        """cache the token of the url; the file is replaced atomically"""
+        logger = logging.getLogger("credential_store")
+        entries = self.load()
+        if entries is None:
+            return
+        entries.setdefault(url, {}).update(username=username, token=token, expires=expires)
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        try:
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w") as store_file:
+                json.dump(entries, store_file, indent=2)
+            os.chmod(tmp_path, 0o600)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.warning("Ansible token wasn't cached: {}".format(e))
+
+
+def get_ansible_credentials(config, store_path):
+    """
+    Ansible credentials resolved once per process. Values are taken from environment
+    variables, the config, the credential store and (in a terminal only) from the user;
+    the first source having the value wins. Without a token, one is created by username
+    and password and it is cached in the store until it expires ('cache_token' value
+    of [ansible] section).
+    """
+    global _credentials
+    logger = logging.getLogger("get_ansible_credentials")
+    with _credentials_lock:
+        if _credentials:
+            return _credentials
+
+        store = CredentialStore(store_path)
+        providers = (
+            ("environment", env_credentials),
+            ("config", config_credentials),
+            ("credential store", store.credentials),
+            ("prompt", prompt_credentials),
+        )
+        found = {}
+        for source, provider in providers:
+            if found.get("url") and found.get("username") and found.get("token"):
+                break
+            for field, value in provider(found, config).items():
+                if value and not found.get(field):
+                    found[field] = value
+                    shown = "*" * len(value) if field in ("token", "password") else value
+                    logger.info("Using 'ansible {}' from {}: '{}'".format(field, source, shown))
+
+        if (not found.get("token") and found.get("url") and found.get("username")
+                and found.get("password")):
+            token, expires = create_ansible_token(found["url"], found["username"],
+                                                  found["password"])
+            found["token"] = token
+            cache_token = True
+            try:
+                cache_token = config.getboolean("ansible", "cache_token")
+            except (configparser.NoOptionError, configparser.NoSectionError, ValueError):
+                pass
+            if token and cache_token:
+                store.save_token(found["url"], found["username"], token, expires)
+
+        for field in ("url", "username"):
+            if not found.get(field):
+                logger.error("Ansible {} wasn't entered.".format(field))
+        if not (found.get("token") or found.get("password")):
+            logger.error("Ansible token wasn't entered.")
+
+        _credentials = AnsibleCredentials(url=found.get("url"),
+                                          username=found.get("username"),
+                                          password=found.get("password", ""),
+                                          token=found.get("token"))
+        return _credentials
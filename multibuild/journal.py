@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import os
+import threading
+import time
+
+
+class Journal(object):
+    """
+    Append-only journal (JSON lines) of the run - stage, NVR, task ID and result of each
+    branch. A resumed run skips stages that already succeeded in the journaled run.
+    """
+    def __init__(self, path, resume=False):
+        """
+        resume: continue the journaled run; otherwise a new journal is started
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        # the last succeeded entries of the resumed run: {(branch, stage): entry}
+        self.completed = {}
+        if resume:
+            self.load()
+        elif os.path.exists(path):
+            os.remove(path)
+
+    def load(self):
+        logger = logging.getLogger("journal")
+        if not os.path.isfile(self.path):
+            logger.warning("There is no journal to resume: '{}'".format(self.path))
+            return
+        with open(self.path) as journal_file:
+            for line in journal_file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # the last line of interrupted run can be incomplete
+                    continue
+                key = (entry.get("branch"), entry.get("stage"))
+                if entry.get("succeeded"):
+                    self.completed[key] = entry
+                else:
+                    self.completed.pop(key, None)
+        logger.info("Resuming run with {} completed stages".format(len(self.completed)))
+
+    def get_completed(self, branch, stage):
+        """
+        journal entry of the stage if it already succeeded, otherwise None
+        """
+        return self.completed.get((branch, stage))
+
+    def record(self, branch, stage, result, succeeded, nvr=None, task_id=None):
+        entry = {
+            "time": time.time(),
+            "branch": branch,
+            "stage": stage,
+            "nvr": nvr,
+            "task_id": task_id,
+            "result": result,
+            "succeeded": succeeded,
+        }
+        with self.lock:
+            with open(self.path, "a") as journal_file:
+                journal_file.write(json.dumps(entry) + "\n")
@@ -2,19 +2,52 @@
 
 import logging
 import os
+import threading
 
-import koji
+from .metrics import run_metrics
+
+
+def koji_module():
+    """the koji module; it is imported just by modes that need it - it is slow to import"""
+    import koji
+    return koji
+
+
+def build_state_name(bdata):
+    """name of the build's state (COMPLETE, BUILDING, ...)"""
+    return koji_module().BUILD_STATES[bdata["state"]]
 
 
 class Kojiwrapper(object):
+    # shared wrappers per koji profile; see 'get_instance'
+    instances = {}
+    instances_lock = threading.Lock()
+    # persistent BuildCache shared by all profiles; None disables it
+    cache = None
+
     def __init__(self, kojiprofile="brew"):
         """Init the object and some configuration details."""
 
         self.kojiprofile = kojiprofile
         self.anon_kojisession = None
+        # koji session isn't thread-safe; it is used by one thread at a time
+        self.lock = threading.RLock()
+        # build data loaded in advance by 'prefetch_builds'; None for unknown builds
+        self.builds = {}
+        # names of tags of builds loaded by 'prefetch_tags': {nvr: [tag, ...]}
+        self.tags = {}
+
+    @classmethod
+    def get_instance(cls, kojiprofile="brew"):
+        """Wrapper (and koji session) shared by all threads using the same profile."""
+        with cls.instances_lock:
+            if kojiprofile not in cls.instances:
+                cls.instances[kojiprofile] = cls(kojiprofile)
+            return cls.instances[kojiprofile]
 
     def load_anon_kojisession(self):
         """Initiate a koji session."""
+        koji = koji_module()
         logger = logging.getLogger("load_anon_kojisession")
         koji_config = koji.read_config(self.kojiprofile)
 
@@ -31,17 +64,102 @@ class Kojiwrapper(object):
         else:
             return session
 
+    def get_session(self):
+        """Koji session; it is initiated with the first use. Call it with the lock held."""
+        if not self.anon_kojisession:
+            self.anon_kojisession = self.load_anon_kojisession()
+        return self.anon_kojisession
+
+    def multicall(self, calls):
+        """
+        Execute calls [(method, args, kwargs), ...] in a single round trip.
+        Returns list of results; each of them is [value] or a fault dict.
+        """
+        if not calls:
+            return []
+        run_metrics.count("hub_calls")
+        with self.lock:
+            session = self.get_session()
+            session.multicall = True
+            for method, args, kwargs in calls:
+                getattr(session, method)(*args, **kwargs)
+            return session.multiCall(strict=False)
+
+    def cached_build(self, build):
+        """Build data from the persistent cache or None."""
+        if not self.cache:
+            return None
+        bdata = self.cache.get(self.kojiprofile, build)
+        if bdata:
+            self.builds[build] = bdata
+        return bdata
+
+    def store_build(self, build, bdata):
+        """Remember build data; completed builds are also stored in the persistent cache."""
+        self.builds[build] = bdata
+        if self.cache and bdata and build_state_name(bdata) == "COMPLETE":
+            self.cache.put(self.kojiprofile, build, bdata)
+
+    def prefetch_builds(self, builds):
+        """Load data of all N-V-Rs in a single multicall. 'get_build' uses them later."""
+        logger = logging.getLogger("prefetch_builds")
+
+        builds = [build for build in builds
+                  if build and build not in self.builds and not self.cached_build(build)]
+        if not builds:
+            return
+        logger.debug('Getting data of %d builds from the build system', len(builds))
+        results = self.multicall([("getBuild", (build,), {}) for build in builds])
+        for build, result in zip(builds, results):
+            if isinstance(result, dict):
+                # fault of the particular call
+                logger.error("getBuild '{}': {}".format(build, result.get("faultString")))
+                continue
+            self.store_build(build, result[0])
+
     def get_build(self, build):
         """Determine the git hash used to produce a particular N-V-R"""
         logger = logging.getLogger("get_build")
 
-        if not self.anon_kojisession:
-            self.anon_kojisession = self.load_anon_kojisession()
-
-        # Get the build data from the nvr
-        logger.debug('Getting task data from the build system')
-        bdata = self.anon_kojisession.getBuild(build)
+        if build not in self.builds and not self.cached_build(build):
+            # Get the build data from the nvr
+            logger.debug('Getting task data from the build system')
+            run_metrics.count("hub_calls")
+            with self.lock:
+                bdata = self.get_session().getBuild(build)
+            self.store_build(build, bdata)
+        bdata = self.builds[build]
         if not bdata:
             raise Exception('Unknown build: %s' % build)
 
         return bdata
+
+    def forget_build(self, build):
+        """
+        Drop data (also unknown ones) and tags of the build loaded so far; used when
+        the build was just submitted.
+        """
+        with self.lock:
+            self.builds.pop(build, None)
+            self.tags.pop(build, None)
+
+    def prefetch_tags(self, builds):
+        """Load tags of all N-V-Rs in a single multicall. 'get_tags' uses them later."""
+        logger = logging.getLogger("prefetch_tags")
+
+        builds = [build for build in builds if build and build not in self.tags]
+        results = self.multicall([("listTags", (build,), {}) for build in builds])
+        for build, result in zip(builds, results):
+            if isinstance(result, dict):
+                logger.error("listTags '{}': {}".format(build, result.get("faultString")))
+                continue
+            self.tags[build] = [tag["name"] for tag in result[0]]
+
+    def get_tags(self, build):
+        """Names of tags of the N-V-R"""
+        if build not in self.tags:
+            run_metrics.count("hub_calls")
+            with self.lock:
+                tags = self.get_session().listTags(build)
+            self.tags[build] = [tag["name"] for tag in tags]
+        return self.tags[build]
@@ -1,22 +1,178 @@
 # -*- coding: utf-8 -*-
 
+import collections
+import os
+import sys
+import tempfile
+import threading
+
+
+class BranchLog(object):
+    """
+    messages of one stream (output/errors) of a branch; only the last messages within
+    the limits are kept in memory
+    """
+    def __init__(self, max_lines=None, max_bytes=None, spill_path=None):
+        """
+        spill_path: callable returning path of a file the complete stream is written to
+        once 'max_bytes' is exceeded; without it, the oldest messages are just dropped
+        """
+        self.messages = collections.deque()
+        self.size = 0
+        self.max_lines = max_lines
+        self.max_bytes = max_bytes
+        self.spill_path = spill_path
+        self.spill_file = None
+        self.dropped = 0
+
+    def over_limits(self):
+        return ((self.max_lines and len(self.messages) > self.max_lines)
+                or (self.max_bytes and self.size > self.max_bytes))
+
+    def append(self, msg):
+        self.messages.append(msg)
+        self.size += len(msg)
+        if self.spill_file:
+            self.spill_file.write(msg)
+        elif self.spill_path and self.max_bytes and self.size > self.max_bytes:
+            self.spill_file = open(self.spill_path(), "w")
+            for message in self.messages:
+                self.spill_file.write(message)
+        while len(self.messages) > 1 and self.over_limits():
+            self.size -= len(self.messages.popleft())
+            self.dropped += 1
+        if self.max_bytes and self.size > self.max_bytes:
+            # the only message is too long itself; its end is kept
+            self.messages[0] = self.messages[0][-self.max_bytes:]
+            self.size = len(self.messages[0])
+
+    def close(self):
+        if self.spill_file:
+            self.spill_file.close()
+
 
 class LogBuffer(object):
     """
-    stores error and standard output messages in groups per thread name
+    stores error and standard output messages and summary records per thread name;
+    it is shared by all threads
     """
-    def __init__(self):
+    def __init__(self, stream=False, max_lines=None, log_dir=None, max_bytes=None):
+        """
+        stream: print lines of commands' output to the console as they come
+        max_lines: only the last lines of output are kept per branch
+        log_dir: complete output of commands is written to <log_dir>/<branch>.log
+        max_bytes: size (characters) of output and of errors kept in memory per branch;
+            the complete output is spilled to a file in 'log_dir' (or temporary directory)
+        """
         self.error_buff = {}
         self.output_buff = {}
+        # summary records of branches' builds: {name: {"nvr": ..., "build_id": ..., ...}}
+        self.summary_records = {}
+        self.stream = stream
+        self.max_lines = max_lines
+        self.max_bytes = max_bytes
+        self.log_dir = log_dir
+        self.spill_dir = None
+        self.log_files = {}
+        self.lock = threading.Lock()
+
+    def _spill_path(self, name, suffix):
+        """
+        path of the file the branch's stream is spilled to; call it with the lock held
+        """
+        if not self.spill_dir:
+            if self.log_dir:
+                os.makedirs(self.log_dir, exist_ok=True)
+            self.spill_dir = self.log_dir or tempfile.mkdtemp(prefix="multibuild-")
+        return os.path.join(self.spill_dir, "{}.{}.log".format(name.replace("/", "_"), suffix))
+
+    def _append(self, buff, name, msg, suffix):
+        with self.lock:
+            if name not in buff:
+                buff[name] = BranchLog(self.max_lines, self.max_bytes,
+                                       lambda: self._spill_path(name, suffix))
+            buff[name].append(msg)
 
     def append_error(self, name, msg):
-        self.error_buff.setdefault(name, []).append(msg)
+        self._append(self.error_buff, name, msg, "err")
 
     def get_errors(self, name):
-        return self.error_buff.get(name, [])
+        with self.lock:
+            return list(self.error_buff[name].messages) if name in self.error_buff else []
 
     def append_output(self, name, msg):
-        self.output_buff.setdefault(name, []).append(msg)
+        self._append(self.output_buff, name, msg, "out")
 
     def get_output(self, name):
-        return self.output_buff.get(name, [])
+        with self.lock:
+            return list(self.output_buff[name].messages) if name in self.output_buff else []
+
+    def add_record(self, name, record):
+        """summary record of the branch's build; the last one is kept"""
+        with self.lock:
+            self.summary_records[name] = record
+
+    def get_records(self, names):
+        """summary records in order of the names; branches without record are left out"""
+        with self.lock:
+            return [self.summary_records[name] for name in names
+                    if name in self.summary_records]
+
+    def print_branch(self, name, file=None):
+        """write kept errors and output of the branch (to stdout by default)"""
+        file = file or sys.stdout
+        with self.lock:
+            for label, buff in (("err", self.error_buff), ("out", self.output_buff)):
+                file.write(label + ": ")
+                branch_log = buff.get(name)
+                if not branch_log:
+                    file.write("\n")
+                    continue
+                if branch_log.spill_file:
+                    file.write("[complete {} in {}]\n".format(
+                        "output" if label == "out" else "errors", branch_log.spill_file.name))
+                elif branch_log.dropped:
+                    file.write("[{} older messages dropped]\n".format(branch_log.dropped))
+                for msg in branch_log.messages:
+                    file.write(msg)
+                file.write("\n")
+            file.flush()
+
+    def line_handler(self, name):
+        """
+        Callback for 'execute_command' passing the lines of the branch's output
+        to the console and the log file. None when streaming is off.
+        """
+        if not (self.stream or self.log_dir):
+            return None
+
+        def handle_line(line, is_error):
+            if is_error:
+                self.append_error(name, line)
+            else:
+                self.append_output(name, line)
+            with self.lock:
+                if self.stream:
+                    print("[{}] {}".format(name, line), end="", flush=True)
+                if self.log_dir:
+                    self._log_file(name).write(line)
+        return handle_line
+
+    def _log_file(self, name):
+        """
+        log file of the branch; call it with the lock held
+        """
+        if name not in self.log_files:
+            os.makedirs(self.log_dir, exist_ok=True)
+            path = os.path.join(self.log_dir, "{}.log".format(name.replace("/", "_")))
+            self.log_files[name] = open(path, "w")
+        return self.log_files[name]
+
+    def close(self):
+        with self.lock:
+            for log_file in self.log_files.values():
+                log_file.close()
+            self.log_files = {}
+            for buff in (self.error_buff, self.output_buff):
+                for branch_log in buff.values():
+                    branch_log.close()
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .kojiwrapper import Kojiwrapper
+from .metrics import run_metrics
+
+DEFAULT_LOGS_DIR = "kojilogs"
+CHUNK_SIZE = 1024 * 1024  # bytes
+
+
+class LogDownloader(object):
+    """
+    Downloads logs of build tasks' subtasks (all architectures) in a bounded pool.
+    Tasks and their outputs are looked up in batches through the shared koji session;
+    every worker downloads through its own session.
+    """
+    def __init__(self, kojiprofile="brew", logs_dir=DEFAULT_LOGS_DIR, max_workers=4):
+        self.kojiprofile = kojiprofile
+        self.logs_dir = logs_dir
+        self.max_workers = max_workers
+        self.kojiwrapper = Kojiwrapper.get_instance(kojiprofile)
+        self.local = threading.local()
+
+    def get_subtasks(self, task_ids):
+        """
+        buildArch children of the tasks: {task_id: [subtask, ...]}
+        A task without such children is its own subtask.
+        """
+        logger = logging.getLogger("get_subtasks")
+        children = self.kojiwrapper.multicall(
+            [("getTaskChildren", (task_id,), {}) for task_id in task_ids])
+        infos = self.kojiwrapper.multicall(
+            [("getTaskInfo", (task_id,), {}) for task_id in task_ids])
+        subtasks = {}
+        for task_id, result, info in zip(task_ids, children, infos):
+            if isinstance(result, dict) or isinstance(info, dict) or not info[0]:
+                logger.error("Task_id is not valid: {}".format(task_id))
+                continue
+            build_arch = [child for child in result[0] if child["method"] == "buildArch"]
+            subtasks[task_id] = build_arch or [info[0]]
+        return subtasks
+
+    def get_downloads(self, subtasks):
+        """
+        log files of all subtasks: [(subtask_id, file name, size, local path), ...]
+        """
+        logger = logging.getLogger("get_downloads")
+        tasks = [(task_id, subtask) for task_id, items in subtasks.items() for subtask in items]
+        outputs = self.kojiwrapper.multicall(
+            [("listTaskOutput", (subtask["id"],), {"stat": True}) for __, subtask in tasks])
+        downloads = []
+        for (task_id, subtask), result in zip(tasks, outputs):
+            if isinstance(result, dict):
+                logger.error("Subtask {}: {}".format(subtask["id"], result.get("faultString")))
+                continue
+            subtask_dir = "{}-{}".format(subtask["id"], subtask.get("arch") or "noarch")
+            for file_name, stat in sorted(result[0].items()):
+                if not file_name.endswith(".log"):
+                    continue
+                path = os.path.join(self.logs_dir, str(task_id), subtask_dir, file_name)
+                downloads.append((subtask["id"], file_name, int(stat["st_size"]), path))
+        return downloads
+
+    def get_session(self):
+        """koji session of the current worker"""
+        if not getattr(self.local, "session", None):
+            self.local.session = Kojiwrapper(self.kojiprofile).load_anon_kojisession()
+        return self.local.session
+
+    def download(self, subtask_id, file_name, size, path):
+        """
+        Stream the file to disk in chunks. Existing file of the same size is skipped.
+        Returns True when the file is downloaded.
+        """
+        logger = logging.getLogger("download")
+        if os.path.isfile(path) and os.path.getsize(path) == size:
+            logger.debug("'{}' is already downloaded".format(path))
+            return True
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        session = self.get_session()
+        offset = 0
+        with open(path, "wb") as log_file:
+            while offset < size:
+                run_metrics.count("hub_calls")
+                chunk = session.downloadTaskOutput(subtask_id, file_name, offset=offset,
+                                                   size=CHUNK_SIZE)
+                if not chunk:
+                    break
+                log_file.write(chunk)
+                offset += len(chunk)
+        logger.info("'{}' ({} bytes)".format(path, offset))
+        return offset == size
+
+    def gather(self, task_ids):
+        """
+        Download logs of all tasks. Returns list of invalid tasks and of files that weren't
+        downloaded.
+        """
+        logger = logging.getLogger("gather_logs")
+        subtasks = self.get_subtasks(task_ids)
+        downloads = self.get_downloads(subtasks)
+        failed = ["task {} is not valid".format(task_id) for task_id in task_ids
+                  if task_id not in subtasks]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [(download, executor.submit(self.download, *download))
+                       for download in downloads]
+            for download, future in futures:
+                try:
+                    if not future.result():
+                        failed.append(download[3])
+                except Exception as e:
+                    logger.error("'{}': {}".format(download[3], e))
+                    failed.append(download[3])
+        return failed
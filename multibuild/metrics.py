@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import contextlib
+import contextvars
+import json
+import os
+import threading
+import time
+
+# counters and phases outside of branches' work (batched koji calls, watchers, ...)
+GLOBAL = "(all)"
+PHASE_COLUMN_WIDTH = 8
+
+# branch processed by the current worker thread or coroutine; see Scheduler.run_thread
+current_branch = contextvars.ContextVar("current_branch", default=GLOBAL)
+
+
+class Metrics(object):
+    """
+    Durations of branches' phases and counters (subprocesses, hub calls) of the run.
+    Counters are accounted to the branch processed by the current worker.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.monotonic()
+        # {branch: {phase: [count, seconds]}} in order of first appearance
+        self.phases = collections.OrderedDict()
+        # {branch: Counter({counter: value})}
+        self.counters = collections.OrderedDict()
+
+    def add_phase(self, phase, duration, branch=None):
+        branch = branch or current_branch.get()
+        with self.lock:
+            record = self.phases.setdefault(branch, collections.OrderedDict()).setdefault(
+                phase, [0, 0.0])
+            record[0] += 1
+            record[1] += duration
+
+    @contextlib.contextmanager
+    def measure(self, phase, branch=None):
+        """
+        measure duration of the block as the branch's phase
+        """
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add_phase(phase, time.monotonic() - start, branch)
+
+    def count(self, counter, value=1, branch=None):
+        branch = branch or current_branch.get()
+        with self.lock:
+            self.counters.setdefault(branch, collections.Counter())[counter] += value
+
+    def branch_seconds(self, branch):
+        """{phase: seconds} of the branch so far"""
+        with self.lock:
+            return {phase: round(seconds, 3)
+                    for phase, (__, seconds) in self.phases.get(branch, {}).items()}
+
+    def branches(self):
+        """branches in order of first appearance; the global record goes last"""
+        branches = list(self.phases)
+        branches += [branch for branch in self.counters if branch not in self.phases]
+        if GLOBAL in branches:
+            branches.remove(GLOBAL)
+            branches.append(GLOBAL)
+        return branches
+
+    def to_dict(self):
+        with self.lock:
+            branches = collections.OrderedDict()
+            for branch in self.branches():
+                phases = self.phases.get(branch, {})
+                counters = self.counters.get(branch, {})
+                branches[branch] = {
+                    "phases": {phase: {"count": count, "seconds": round(seconds, 3)}
+                               for phase, (count, seconds) in phases.items()},
+                    "subprocesses": counters.get("subprocesses", 0),
+                    "hub_calls": counters.get("hub_calls", 0),
+                }
+            return {
+                "time": time.time(),
+                "seconds": round(time.monotonic() - self.start, 3),
+                "branches": branches,
+            }
+
+    def to_prometheus(self):
+        """metrics in Prometheus text format (for node exporter's textfile collector)"""
+        def label(value):
+            return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+        data = self.to_dict()
+        lines = [
+            "# HELP multibuild_run_seconds Duration of the last run.",
+            "# TYPE multibuild_run_seconds gauge",
+            "multibuild_run_seconds {}".format(data["seconds"]),
+        ]
+        metrics = (
+            ("phase_seconds", "Total duration of the branch's phase.",
+             lambda record: [(phase, values["seconds"])
+                             for phase, values in record["phases"].items()]),
+            ("phase_count", "Number of runs of the branch's phase.",
+             lambda record: [(phase, values["count"])
+                             for phase, values in record["phases"].items()]),
+            ("subprocesses", "Number of processes started for the branch.",
+             lambda record: [(None, record["subprocesses"])]),
+            ("hub_calls", "Number of koji hub round trips for the branch.",
+             lambda record: [(None, record["hub_calls"])]),
+        )
+        for name, description, values in metrics:
+            lines.append("# HELP multibuild_{} {}".format(name, description))
+            lines.append("# TYPE multibuild_{} gauge".format(name))
+            for branch, record in data["branches"].items():
+                for phase, value in values(record):
+                    labels = 'branch="{}"'.format(label(branch))
+                    if phase:
+                        labels += ',phase="{}"'.format(label(phase))
+                    lines.append("multibuild_{}{{{}}} {}".format(name, labels, value))
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """
+        Write metrics to the file - in Prometheus text format when its suffix is '.prom',
+        otherwise as JSON. The file is replaced atomically.
+        """
+        if path.endswith(".prom"):
+            content = self.to_prometheus()
+        else:
+            content = json.dumps(self.to_dict(), indent=2) + "\n"
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as metrics_file:
+            metrics_file.write(content)
+        os.replace(tmp_path, path)
+
+    def print_table(self):
+        """seconds spent in phases, subprocesses and hub calls per branch"""
+        data = self.to_dict()
+        if not data["branches"]:
+            return
+        phases = []
+        for record in data["branches"].values():
+            phases += [phase for phase in record["phases"] if phase not in phases]
+        widths = [max(len(phase), PHASE_COLUMN_WIDTH) for phase in phases]
+        name_width = max(len(branch) for branch in data["branches"])
+        header = "{:<{}}".format("branch", name_width)
+        header += "".join("  {:>{}}".format(phase, width) for phase, width in zip(phases, widths))
+        header += "  {:>5}  {:>5}".format("procs", "hub")
+        print("Metrics (seconds):")
+        print(header)
+        print("-" * len(header))
+        for branch, record in data["branches"].items():
+            row = "{:<{}}".format(branch, name_width)
+            for phase, width in zip(phases, widths):
+                seconds = record["phases"].get(phase, {}).get("seconds")
+                row += "  {:>{}}".format("-" if seconds is None else "{:.2f}".format(seconds),
+                                         width)
+            row += "  {:>5}  {:>5}".format(record["subprocesses"], record["hub_calls"])
+            print(row)
+        print("total {:.2f} s".format(data["seconds"]), flush=True)
+
+
+# metrics of the current run
+run_metrics = Metrics()
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import re
+
+from .tools import execute_command, get_dist_tag
+
+DEFAULT_NVR_FORMAT = "{name}-{version}-{release}"
+# expansion of nested macros is limited
+MAX_MACRO_DEPTH = 10
+
+MACRO_DEFINITION = re.compile(r"^%(?:global|define)\s+(\w+)\s+(.+?)\s*$")
+TAG_DEFINITION = re.compile(r"^(Name|Version|Release)\s*:\s*(.+?)\s*$", re.IGNORECASE)
+MACRO_USAGE = re.compile(r"%(?:\{(\??)(\w+)\}|(\w+))")
+CONDITIONAL = re.compile(r"^%(if\w*|else|elif\w*|endif)\b")
+
+
+def _branch_commit(branch, cwd=None):
+    """
+    commit hash of the branch's HEAD or None
+    """
+    command = ["git", "rev-parse", "--verify", branch]
+    commit, __, ret = execute_command(branch, command, cwd=cwd)
+    if ret:
+        return None
+    return commit
+
+
+def _read_spec(branch, commit, cwd=None):
+    """
+    Content of the spec file in the commit read directly from git - no checkout is needed.
+    Returns None when there isn't just one spec file.
+    """
+    logger = logging.getLogger("read_spec")
+    out, __, ret = execute_command(branch, ["git", "ls-tree", "--name-only", commit], cwd=cwd)
+    spec_files = [path for path in out.splitlines() if path.endswith(".spec")]
+    if ret or len(spec_files) != 1:
+        logger.debug("No unique spec file in branch '{}'".format(branch))
+        return None
+
+    spec_ref = "{}:{}".format(commit, spec_files[0])
+    spec, __, ret = execute_command(branch, ["git", "show", spec_ref], cwd=cwd)
+    if ret:
+        return None
+    return spec
+
+
+def _expand(value, macros, ambiguous, depth=0):
+    """
+    Expand macros in the value. Undefined and ambiguous macros stay unexpanded,
+    conditional ones (%{?macro}) too - the buildroot can define them (%{?rhel}, ...).
+    """
+    def replace(match):
+        name = match.group(2) or match.group(3)
+        if name in ambiguous or name not in macros:
+            return match.group(0)
+        return _expand(macros[name], macros, ambiguous, depth + 1)
+
+    if depth > MAX_MACRO_DEPTH:
+        return value
+    return MACRO_USAGE.sub(replace, value)
+
+
+def parse_spec(spec, dist=""):
+    """
+    Read name, version and release from the spec file content.
+    Returns dict or None when values can't be resolved without rpm
+    (conditional blocks before the tags, definitions in conditional blocks, unknown macros,
+    %autorelease, ...).
+    """
+    macros = {"dist": dist}
+    ambiguous = set()
+    tags = {}
+    depth = 0
+    for line in spec.splitlines():
+        line = line.strip()
+        match = CONDITIONAL.match(line)
+        if match:
+            if len(tags) != 3:
+                return None
+            if match.group(1).startswith("if"):
+                depth += 1
+            elif match.group(1) == "endif":
+                depth -= 1
+            continue
+        match = MACRO_DEFINITION.match(line)
+        if match and depth:
+            return None
+        if match:
+            name, value = match.groups()
+            if name in macros and macros[name] != value:
+                ambiguous.add(name)
+            macros[name] = value
+            continue
+        match = TAG_DEFINITION.match(line)
+        if match and depth:
+            return None
+        if match:
+            tag, value = match.group(1).lower(), match.group(2)
+            if tag in tags and tags[tag] != value:
+                return None
+            tags.setdefault(tag, value)
+            macros.setdefault(tag, value)
+
+    if len(tags) != 3:
+        return None
+    values = {}
+    for tag, value in tags.items():
+        values[tag] = _expand(value, macros, ambiguous)
+        if "%" in values[tag]:
+            return None
+    return values
+
+
+def nvr_from_spec(branch, nvr_format=None, cwd=None):
+    """
+    Find out NVR of the branch's HEAD from its spec file without checkout and rpkg tools.
+    'nvr_format' template can use {name}, {version}, {release}, {dist} and {branch} fields.
+    Returns None when the NVR can't be resolved this way.
+    """
+    logger = logging.getLogger("nvr_from_spec")
+    dist = get_dist_tag(branch)
+    if dist is None:
+        logger.debug("Unknown dist tag for branch '{}'".format(branch))
+        return None
+
+    commit = _branch_commit(branch, cwd)
+    if not commit:
+        return None
+    nvr_format = nvr_format or DEFAULT_NVR_FORMAT
+    spec = _read_spec(branch, commit, cwd)
+    if not spec:
+        return None
+
+    values = parse_spec(spec, dist)
+    if not values:
+        logger.debug("Spec file of branch '{}' needs rpm to be evaluated".format(branch))
+        return None
+    try:
+        nvr = nvr_format.format(dist=dist, branch=branch, **values)
+    except (KeyError, IndexError, ValueError) as e:
+        logger.error("Invalid NVR format '{}': {}".format(nvr_format, e))
+        return None
+    return nvr
@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import configparser
+import logging
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+from .tools import execute_command
+
+# what to do with branches in given state; 'push' is valid just for unpushed commits
+PREFLIGHT_ACTIONS = ("refuse", "warn", "ignore", "push")
+DEFAULT_ACTIONS = {
+    "unpushed": "refuse",
+    "behind": "warn",
+    "dirty": "warn",
+}
+DEFAULT_REMOTE = "origin"
+MAX_WORKERS = 10
+
+# %(upstream:track,nobracket): "ahead 2", "behind 1", "ahead 2, behind 1" or "gone"
+TRACK_AHEAD = re.compile(r"ahead (\d+)")
+TRACK_BEHIND = re.compile(r"behind (\d+)")
+REF_FORMAT = "%00".join([
+    "%(refname)",
+    "%(HEAD)",
+    "%(upstream:short)",
+    "%(upstream:remotename)",
+    "%(upstream:remoteref)",
+    "%(upstream:track,nobracket)",
+])
+
+
+def _track_count(pattern, track):
+    match = pattern.search(track)
+    return int(match.group(1)) if match else 0
+
+
+def get_preflight_actions(config):
+    """
+    actions for branch states from [preflight] section:
+    unpushed (refuse/warn/ignore/push), behind and dirty (refuse/warn/ignore)
+    """
+    logger = logging.getLogger("preflight")
+    actions = dict(DEFAULT_ACTIONS)
+    for state in actions:
+        try:
+            action = config.get("preflight", state)
+        except (configparser.NoOptionError, configparser.NoSectionError):
+            continue
+        if action not in PREFLIGHT_ACTIONS or (action == "push" and state != "unpushed"):
+            logger.warning("Invalid '{}' value in [preflight] section: {}".format(state, action))
+            continue
+        actions[state] = action
+    return actions
+
+
+class Preflight(object):
+    """
+    Checks local branches against their remote branches before builds are submitted -
+    unpushed commits, branches behind the remote and uncommitted changes. Branches
+    aren't checked out; all of them are checked by a few git commands.
+    """
+    def __init__(self, branches, cwd=None):
+        self.branches = branches
+        self.cwd = cwd
+        # existing remote-tracking branches of the branches; see 'read_refs'
+        self.remote_refs = set()
+
+    def fetch(self, remotes):
+        """update remote-tracking branches of the remotes by one 'git fetch'"""
+        logger = logging.getLogger("preflight")
+        command = ["git", "fetch", "--quiet", "--multiple"] + sorted(remotes)
+        __, err, ret = execute_command("preflight", command, cwd=self.cwd)
+        if ret:
+            logger.warning("Fetching {} failed: {}".format(", ".join(sorted(remotes)), err))
+        return ret == 0
+
+    def read_refs(self):
+        """
+        Local branches and their upstreams: {branch: state}
+        Remote branches of the same names (in 'origin') are stored in 'remote_refs'.
+        """
+        patterns = []
+        for branch in self.branches:
+            patterns.append("refs/heads/{}".format(branch))
+            patterns.append("refs/remotes/{}/{}".format(DEFAULT_REMOTE, branch))
+        command = ["git", "for-each-ref", "--format={}".format(REF_FORMAT)] + patterns
+        out, __, ret = execute_command("preflight", command, cwd=self.cwd)
+        states = {}
+        self.remote_refs = set()
+        if ret:
+            return states
+        for line in out.splitlines():
+            ref, head, upstream, remote, remote_ref, track = line.split("\0")
+            if not ref.startswith("refs/heads/"):
+                self.remote_refs.add(ref)
+                continue
+            branch = ref[len("refs/heads/"):]
+            states[branch] = {
+                "upstream": upstream or None,
+                "remote": remote or None,
+                "remote_ref": remote_ref or None,
+                "ahead": _track_count(TRACK_AHEAD, track),
+                "behind": _track_count(TRACK_BEHIND, track),
+                "gone": track == "gone",
+                "current": head == "*",
+                "dirty": False,
+            }
+        return states
+
+    @staticmethod
+    def remote_ref(branch):
+        """remote-tracking branch of the same name"""
+        return "refs/remotes/{}/{}".format(DEFAULT_REMOTE, branch)
+
+    def count_divergence(self, branch, upstream):
+        """(ahead, behind) of the branch compared to the remote branch or None"""
+        command = ["git", "rev-list", "--left-right", "--count",
+                   "refs/heads/{}...{}".format(branch, upstream)]
+        out, __, ret = execute_command(branch, command, cwd=self.cwd)
+        if ret:
+            return None
+        ahead, behind = out.split()
+        return int(ahead), int(behind)
+
+    def is_dirty(self):
+        """whether tracked files of the current checkout are modified"""
+        command = ["git", "status", "--porcelain", "--untracked-files=no"]
+        out, __, ret = execute_command("preflight", command, cwd=self.cwd)
+        return ret == 0 and bool(out)
+
+    def check(self, fetch=True):
+        """
+        States of branches in their order: {branch: state}; None for missing branches.
+        Branches without upstream are compared to the branch of the same name
+        in 'origin' remote.
+        """
+        states = self.read_refs()
+        if fetch:
+            remotes = {state["remote"] for state in states.values() if state["remote"]}
+            if self.fetch(remotes or [DEFAULT_REMOTE]):
+                # ahead/behind against the fetched remote branches
+                states = self.read_refs()
+
+        without_upstream = [branch for branch, state in states.items() if not state["upstream"]]
+        without_upstream = [branch for branch in without_upstream
+                            if self.remote_ref(branch) in self.remote_refs]
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            divergences = executor.map(
+                lambda branch: self.count_divergence(branch, self.remote_ref(branch)),
+                without_upstream)
+            for branch, divergence in zip(without_upstream, divergences):
+                if divergence:
+                    states[branch].update(upstream="{}/{}".format(DEFAULT_REMOTE, branch),
+                                          remote=DEFAULT_REMOTE,
+                                          remote_ref="refs/heads/{}".format(branch))
+                    states[branch]["ahead"], states[branch]["behind"] = divergence
+
+        if any(state["current"] for state in states.values()) and self.is_dirty():
+            for state in states.values():
+                state["dirty"] = state["current"]
+        return collections.OrderedDict((branch, states.get(branch)) for branch in self.branches)
+
+    @staticmethod
+    def find_problems(states):
+        """
+        branches in problematic states: {"missing"/"unpushed"/"behind"/"dirty": [branch, ...]}
+        Branches without upstream (or with removed one) are unpushed.
+        """
+        problems = collections.OrderedDict((problem, []) for problem in
+                                           ("missing", "unpushed", "behind", "dirty"))
+        for branch, state in states.items():
+            if not state:
+                problems["missing"].append(branch)
+                continue
+            if state["ahead"] or state["gone"] or not state["upstream"]:
+                problems["unpushed"].append(branch)
+            if state["behind"]:
+                problems["behind"].append(branch)
+            if state["dirty"]:
+                problems["dirty"].append(branch)
+        return problems
+
+    def push(self, branches, states):
+        """
+        Push the branches to their remote branches; one 'git push' per remote.
+        Returns True when all of them were pushed.
+        """
+        logger = logging.getLogger("preflight")
+        refspecs = collections.defaultdict(list)
+        for branch in branches:
+            state = states[branch]
+            if not state["remote_ref"] or state["gone"]:
+                logger.error("Branch '{}' has no remote branch to push to".format(branch))
+                return False
+            refspec = "refs/heads/{}:{}".format(branch, state["remote_ref"])
+            refspecs[state["remote"]].append(refspec)
+        pushed = True
+        for remote, remote_refspecs in refspecs.items():
+            command = ["git", "push", "--quiet", remote] + remote_refspecs
+            __, err, ret = execute_command("preflight", command, cwd=self.cwd)
+            if ret:
+                logger.error("Pushing to '{}' failed: {}".format(remote, err))
+                pushed = False
+        if pushed:
+            for branch in branches:
+                states[branch]["ahead"] = 0
+        return pushed
+
+    @staticmethod
+    def print_table(states):
+        width = max(len(branch) for branch in states)
+        upstream_width = max([len("upstream")] + [len(state["upstream"] or "-")
+                                                  for state in states.values() if state])
+        line = "{:<{}}  {:<{}}  {:>5}  {:>6}  {}"
+        header = line.format("branch", width, "upstream", upstream_width, "ahead", "behind",
+                             "dirty")
+        print(header)
+        print("-" * len(header))
+        for branch, state in states.items():
+            if not state:
+                print("{:<{}}  missing".format(branch, width))
+                continue
+            upstream = state["upstream"] or "-"
+            if state["gone"]:
+                upstream += " (gone)"
+            print(line.format(branch, width, upstream, upstream_width, state["ahead"],
+                              state["behind"], "yes" if state["dirty"] else ""))
+        print("-" * len(header), flush=True)
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import time
+
+from .kojiwrapper import koji_module
+
+DEFAULT_TIMEOUT = 120 * 60  # seconds; the same as 'koji wait-repo' has
+MIN_POLL_INTERVAL = 10  # seconds
+MAX_POLL_INTERVAL = 120  # seconds
+POLL_BACKOFF = 1.5
+
+
+class RepoWaiter(object):
+    """
+    Waits for regeneration of build tags' repositories containing given builds.
+    All tags are polled together through one koji session; the polling interval
+    grows while nothing changes.
+    """
+    def __init__(self, kojiwrapper, timeout=DEFAULT_TIMEOUT,
+                 min_interval=MIN_POLL_INTERVAL, max_interval=MAX_POLL_INTERVAL):
+        self.kojiwrapper = kojiwrapper
+        self.timeout = timeout
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+
+    @staticmethod
+    def latest_builds_call(tag, nvr, event=None):
+        package = koji_module().parse_NVR(nvr)["name"]
+        return ("getLatestBuilds", (tag,), {"event": event, "package": package})
+
+    @staticmethod
+    def contains(result, nvr):
+        return not isinstance(result, dict) and nvr in [build["nvr"] for build in result[0]]
+
+    def check_tagged(self, builds):
+        """
+        Returns tags whose builds are tagged (directly or by inheritance).
+        """
+        logger = logging.getLogger("repo_waiter")
+        pairs = [(tag, nvr) for tag, nvrs in builds.items() for nvr in nvrs]
+        results = self.kojiwrapper.multicall(
+            [self.latest_builds_call(tag, nvr) for tag, nvr in pairs])
+        tagged = list(builds)
+        for (tag, nvr), result in zip(pairs, results):
+            if isinstance(result, dict):
+                logger.error("Tag '{}': {}".format(tag, result.get("faultString")))
+            elif not self.contains(result, nvr):
+                logger.error("Build '{}' isn't tagged in '{}'".format(nvr, tag))
+            else:
+                continue
+            if tag in tagged:
+                tagged.remove(tag)
+        return tagged
+
+    def wait(self, builds):
+        """
+        builds: {tag: nvr} or {tag: [nvr, ...]}
+        Returns {tag: True/False} - whether the tag's repo with the builds is ready.
+        """
+        logger = logging.getLogger("repo_waiter")
+        builds = {tag: [nvrs] if isinstance(nvrs, str) else list(nvrs)
+                  for tag, nvrs in builds.items()}
+        results = {tag: False for tag in builds}
+        pending = self.check_tagged(builds)
+        repo_ids = {}
+        start = time.monotonic()
+        interval = self.min_interval
+
+        while pending:
+            repos = self.kojiwrapper.multicall([("getRepo", (tag,), {}) for tag in pending])
+            checks = []
+            progressed = False
+            for tag, repo in zip(pending, repos):
+                if isinstance(repo, dict) or not repo[0]:
+                    logger.warning("Tag '{}': no repo yet".format(tag))
+                    continue
+                repo = repo[0]
+                if repo_ids.get(tag) != repo["id"]:
+                    repo_ids[tag] = repo["id"]
+                    progressed = True
+                    logger.info("Tag '{}': repo {} from {}".format(
+                        tag, repo["id"], time.ctime(repo["create_ts"])))
+                checks.append((tag, repo["create_event"]))
+
+            pairs = [(tag, event, nvr) for tag, event in checks for nvr in builds[tag]]
+            found = self.kojiwrapper.multicall(
+                [self.latest_builds_call(tag, nvr, event) for tag, event, nvr in pairs])
+            missing = {tag for (tag, __, nvr), result in zip(pairs, found)
+                       if not self.contains(result, nvr)}
+            for tag, __ in checks:
+                if tag not in missing:
+                    logger.info("Tag '{}': repo {} contains '{}' ({:.0f} s)".format(
+                        tag, repo_ids[tag], "', '".join(builds[tag]), time.monotonic() - start))
+                    results[tag] = True
+                    pending.remove(tag)
+            if not pending:
+                break
+
+            elapsed = time.monotonic() - start
+            if self.timeout and elapsed >= self.timeout:
+                logger.error("Timeout while waiting for repos of: {}".format(", ".join(pending)))
+                break
+            # poll often while repos are changing
+            if progressed:
+                interval = self.min_interval
+            else:
+                interval = min(interval * POLL_BACKOFF, self.max_interval)
+            if self.timeout:
+                interval = min(interval, self.timeout - elapsed)
+            logger.debug("Waiting for {} repos; next check in {:.0f} s".format(len(pending),
+                                                                               interval))
+            time.sleep(interval)
+        return results
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+
+import configparser
+import logging
+import re
+import threading
+
+DEFAULT_DISTRIBUTION = "RHEL"
+
+DISTRIBUTION_TOOLS = {
+    "RHEL": ("rhpkg", "brew"),
+    "Fedora": ("fedpkg", "koji"),
+}
+
+BRANCH_PATTERNS = {
+    r"^f\d\d$": "Fedora",  # f28 f29
+    r"^epel\d$": "Fedora",  # epel7
+    r"^epel\d\d(?:\.\d+)?$": "Fedora",  # epel10 epel10.1
+    r"^epel\d-playground$": "Fedora",  # epel8-playground
+    r"^el\d$": "Fedora",  # el6
+    r"^(?:master|main|rawhide)$": "Fedora",  # Fedora rawhide (rpkg, fedpkg)
+    r"^eng-rhel-\d+$": "RHEL",  # eng-rhel-7 (rpkg, rhpkg)
+    r"^eng-fedora-\d\d$": "RHEL",  # eng-fedora-30 (rhpkg)
+}
+
+ANSIBLE_PLATFORM_MAPPING = {
+    r"eng-rhel-(\d+)": r"rhel-\1",
+    r"eng-fedora-(\d\d)": r"fedora-\1",
+}
+
+# dist tags (value of %{dist} macro) of branches
+DIST_TAG_MAPPING = {
+    r"^f(\d\d)$": r".fc\1",  # f39 -> .fc39
+    # epel10+ has minor versions in dist tags (.el10_1); NVR is resolved by verrel there
+    r"^epel([6-9])(?:-playground)?$": r".el\1",  # epel8 -> .el8
+    r"^el(\d)$": r".el\1",  # el6 -> .el6
+    r"^eng-rhel-(\d+)$": r".el\1",  # eng-rhel-8 -> .el8
+    r"^eng-fedora-(\d\d)$": r".fc\1",  # eng-fedora-30 -> .fc30
+}
+
+
+def _read_lines(config, section, option, fields):
+    """
+    multi-line config value; each line has 'fields' whitespace-separated items
+    """
+    logger = logging.getLogger("branch_resolver")
+    try:
+        value = config.get(section, option)
+    except (configparser.NoOptionError, configparser.NoSectionError):
+        return []
+    items = []
+    for line in value.splitlines():
+        if not line.strip():
+            continue
+        item = line.split()
+        if len(item) != fields:
+            logger.warning("Invalid line in '{}' value of [{}] section: {}".format(
+                option, section, line))
+            continue
+        items.append(item)
+    return items
+
+
+def _with_builtin(extra, builtin):
+    """
+    mapping of the extra (configured) items followed by the built-in ones; extra values
+    replace the built-in ones and extra patterns are tried first
+    """
+    mapping = dict(extra or {})
+    for key, value in builtin.items():
+        mapping.setdefault(key, value)
+    return mapping
+
+
+class PatternMapping(object):
+    """
+    Ordered mapping of regular expressions to values. All patterns are compiled into one
+    alternation with a named group per pattern, so a branch name is matched just once.
+    """
+    def __init__(self, mapping):
+        self.patterns = list(mapping)
+        self.values = [mapping[pattern] for pattern in self.patterns]
+        self.compiled = [re.compile(pattern) for pattern in self.patterns]
+        self.regex = re.compile("|".join("(?P<p{}>{})".format(i, pattern)
+                                         for i, pattern in enumerate(self.patterns)))
+
+    def match(self, name):
+        """(index of the first matching pattern, match object of the pattern) or None"""
+        match = self.regex.match(name) if self.patterns else None
+        if not match:
+            return None
+        # the pattern's group encloses its inner groups, so it is the last closed one
+        index = int(match.lastgroup[1:])
+        return index, self.compiled[index].match(name)
+
+    def get(self, name, default=None):
+        """value of the first matching pattern"""
+        found = self.match(name)
+        return self.values[found[0]] if found else default
+
+    def substitute(self, name):
+        """name with the first matching pattern replaced by its value (\\1, ... are groups)"""
+        found = self.match(name)
+        if not found:
+            return None
+        index = found[0]
+        return self.compiled[index].sub(self.values[index], name)
+
+
+class BranchResolver(object):
+    """
+    Resolves distribution, its tools, dist tag and ansible platform of branches.
+    Extra patterns from [distributions] section of config take precedence over
+    the built-in ones. Results are memoized per branch name.
+    """
+    # resolver of the run; see 'configure'
+    default = None
+    default_lock = threading.Lock()
+
+    def __init__(self, branch_patterns=None, tools=None, dist_tags=None,
+                 ansible_platforms=None):
+        self.distributions = PatternMapping(_with_builtin(branch_patterns, BRANCH_PATTERNS))
+        self.tools = _with_builtin(tools, DISTRIBUTION_TOOLS)
+        self.dist_tags = PatternMapping(_with_builtin(dist_tags, DIST_TAG_MAPPING))
+        self.ansible_platforms = PatternMapping(
+            _with_builtin(ansible_platforms, ANSIBLE_PLATFORM_MAPPING))
+        # {branch: distribution}
+        self.cache = {}
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        [distributions] section; values have one item per line:
+        patterns = <regex> <distribution>
+        tools = <distribution> <tool> <server_tool>
+        dist_tags = <regex> <dist tag (\\1 refers to the regex's group)>
+        ansible_platforms = <regex> <platform>
+        """
+        section = "distributions"
+        return cls(
+            branch_patterns={pattern: dist
+                             for pattern, dist in _read_lines(config, section, "patterns", 2)},
+            tools={dist: (tool, server_tool)
+                   for dist, tool, server_tool in _read_lines(config, section, "tools", 3)},
+            dist_tags={pattern: tag
+                       for pattern, tag in _read_lines(config, section, "dist_tags", 2)},
+            ansible_platforms={pattern: platform for pattern, platform
+                               in _read_lines(config, section, "ansible_platforms", 2)},
+        )
+
+    @classmethod
+    def configure(cls, config):
+        """set resolver of the run according to the config"""
+        with cls.default_lock:
+            cls.default = cls.from_config(config)
+            return cls.default
+
+    @classmethod
+    def get_default(cls):
+        """resolver of the run; the built-in one unless 'configure' was called"""
+        with cls.default_lock:
+            if not cls.default:
+                cls.default = cls()
+            return cls.default
+
+    def distribution(self, branch):
+        if not branch:
+            raise Exception("Empty branch name")
+        if not isinstance(branch, str):
+            raise Exception("Branch name is not string")
+        if branch not in self.cache:
+            distribution = self.distributions.get(branch)
+            if not distribution:
+                logger = logging.getLogger("recognize_distribution")
+                logger.warning("Distribution wasn't recognized from branch '{}'. "
+                               "Using default: '{}'".format(branch, DEFAULT_DISTRIBUTION))
+                distribution = DEFAULT_DISTRIBUTION
+            self.cache[branch] = distribution
+        return self.cache[branch]
+
+    def distribution_tool(self, distribution):
+        """(tool, server tool) of the distribution"""
+        dist_tool = self.tools.get(distribution)
+        if not dist_tool:
+            raise Exception("Uknown distribution -> no tool detected")
+        return dist_tool
+
+    def dist_tag(self, branch):
+        """dist tag of the branch or None when it is unknown"""
+        return self.dist_tags.substitute(branch)
+
+    def ansible_platform(self, branch):
+        return self.ansible_platforms.substitute(branch)
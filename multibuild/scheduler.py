@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .metrics import current_branch
+
+DEFAULT_MAX_WORKERS = 10
+
+
+class Scheduler(object):
+    """
+    runs work of BuildThreads in a bounded pool of workers
+    """
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS, tool_limits=None, priority=None):
+        """
+        max_workers: number of branches processed at the same time
+        tool_limits: {server_tool: limit} - how many branches can use the server tool at once
+        priority: branches that are processed first (in given order)
+        """
+        self.max_workers = max_workers
+        self.tool_semaphores = {tool: threading.BoundedSemaphore(limit)
+                                for tool, limit in (tool_limits or {}).items() if limit}
+        self.priority = list(priority or [])
+
+    def order(self, threads):
+        """
+        branches with priority (in all repos) go first; others keep their order
+        """
+        def key(thread):
+            if thread.branch in self.priority:
+                return self.priority.index(thread.branch)
+            return len(self.priority)
+        return sorted(threads, key=key)
+
+    def run_thread(self, thread, task):
+        # subprocesses and hub calls of the worker are accounted to the branch
+        token = current_branch.set(thread.name)
+        try:
+            semaphore = self.tool_semaphores.get(thread.server_tool)
+            if not semaphore:
+                return task(thread)
+            with semaphore:
+                return task(thread)
+        finally:
+            current_branch.reset(token)
+
+    def run(self, threads, task=None):
+        """
+        Run all threads (or the task for each of them) and wait for them.
+        Returns results per branch in the original order of threads.
+        """
+        task = task or (lambda thread: thread.run())
+        logger = logging.getLogger("scheduler")
+        logger.debug("Running {} branches in {} workers".format(len(threads), self.max_workers))
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {thread.name: executor.submit(self.run_thread, thread, task)
+                       for thread in self.order(threads)}
+
+        results = collections.OrderedDict()
+        for thread in threads:
+            try:
+                results[thread.name] = futures[thread.name].result()
+            except Exception as e:
+                logger.error("Thread '{}' failed: {}".format(thread.name, e))
+                results[thread.name] = None
+        return results
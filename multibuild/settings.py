@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import configparser
+import logging
+import types
+
+from .resolver import BranchResolver
+
+BUILD_INFO_URL_TEMPLATE = "https://brewweb.engineering.redhat.com/brew/buildinfo?buildID=%d"
+
+# commands which can be killed after time set in [timeouts] section
+TIMEOUT_COMMANDS = ("checkout", "verrel", "command", "tag", "wait-repo")
+
+# settings of BuildThreads resolved from the config once; they are shared by all threads
+Settings = collections.namedtuple("Settings", [
+    "timeouts",  # {command: seconds}; commands without timeout aren't limited; "watch" of tasks
+    "nvr_format",  # format of NVR read from spec files; None means the default one
+    "native_nvr",  # NVR is read from spec files; otherwise by 'verrel' command
+    "build_info_url_templates",  # {server tool: URL template}; empty template means no URL
+    "native_wait_repo",  # repos are polled by multibuild; otherwise by 'wait-repo' command
+    "ansible",  # AnsibleCredentials or None
+])
+
+AnsibleCredentials = collections.namedtuple("AnsibleCredentials",
+                                            ["url", "username", "password", "token"])
+
+
+def _get_value(config, section, option, getter, default=None):
+    """
+    value of the option converted by the config's getter; invalid values are reported
+    and the default is used instead
+    """
+    logger = logging.getLogger("settings")
+    try:
+        return getter(section, option)
+    except (configparser.NoOptionError, configparser.NoSectionError):
+        return default
+    except ValueError as e:
+        logger.warning("Invalid '{}' value in [{}] section: {}".format(option, section, e))
+        return default
+
+
+def load_settings(config, ansible=None, timeout=None):
+    """
+    Settings from the config. Missing values are filled by defaults.
+    ansible: AnsibleCredentials entered by the user (see 'get_ansible_credentials')
+    timeout: seconds of watching build tasks ('--timeout' option)
+    """
+    timeouts = {}
+    for command in TIMEOUT_COMMANDS:
+        command_timeout = _get_value(config, "timeouts", command, config.getfloat)
+        if command_timeout:
+            timeouts[command] = command_timeout
+    if timeout:
+        timeouts["watch"] = timeout
+
+    server_tools = {server_tool for __, server_tool in BranchResolver.get_default().tools.values()}
+    templates = {server_tool: _get_value(config, server_tool, "build_info_url_template",
+                                         config.get, BUILD_INFO_URL_TEMPLATE)
+                 for server_tool in sorted(server_tools)}
+
+    return Settings(
+        timeouts=types.MappingProxyType(timeouts),
+        nvr_format=_get_value(config, "nvr", "format", config.get) or None,
+        native_nvr=_get_value(config, "nvr", "native", config.getboolean, True),
+        build_info_url_templates=types.MappingProxyType(templates),
+        native_wait_repo=_get_value(config, "general", "native_wait_repo",
+                                    config.getboolean, True),
+        ansible=ansible,
+    )
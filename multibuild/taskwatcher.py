@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import time
+
+from .kojiwrapper import koji_module
+
+DEFAULT_TIMEOUT = 24 * 60 * 60  # seconds
+MIN_POLL_INTERVAL = 10  # seconds
+MAX_POLL_INTERVAL = 120  # seconds
+POLL_BACKOFF = 1.5
+FINAL_STATES = ("CLOSED", "CANCELED", "FAILED")
+
+
+class TaskWatcher(object):
+    """
+    Watches build tasks of all branches through one koji session. States of all
+    tasks are checked in one multicall; the polling interval grows while nothing changes.
+    """
+    def __init__(self, kojiwrapper, timeout=DEFAULT_TIMEOUT, min_interval=MIN_POLL_INTERVAL,
+                 max_interval=MAX_POLL_INTERVAL):
+        self.kojiwrapper = kojiwrapper
+        self.timeout = timeout
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+
+    @staticmethod
+    def print_table(tasks, states):
+        width = max(len(name) for name in tasks)
+        print("-" * (width + 30))
+        for name, task_id in tasks.items():
+            print("{name:<{width}}  {task_id:>10}  {state}".format(
+                name=name, width=width, task_id=task_id or "-", state=states.get(name) or "-"))
+        print("-" * (width + 30), flush=True)
+
+    def watch(self, tasks):
+        """
+        tasks: {name: task_id}
+        Returns {name: state name} after all tasks reached a final state or the timeout
+        elapsed. Tasks which can't be found are in UNKNOWN state.
+        """
+        task_states = koji_module().TASK_STATES
+        logger = logging.getLogger("task_watcher")
+        states = {name: None for name in tasks}
+        pending = [name for name, task_id in tasks.items() if task_id]
+        start = time.monotonic()
+        interval = self.min_interval
+
+        while pending:
+            results = self.kojiwrapper.multicall(
+                [("getTaskInfo", (tasks[name],), {}) for name in pending])
+            changed = False
+            for name, result in zip(list(pending), results):
+                if isinstance(result, dict) or not result[0]:
+                    error = result.get("faultString") if isinstance(result, dict) else "not found"
+                    logger.error("Task {}: {}".format(tasks[name], error))
+                    states[name] = "UNKNOWN"
+                    changed = True
+                    pending.remove(name)
+                    continue
+                state = task_states[result[0]["state"]]
+                if states[name] != state:
+                    states[name] = state
+                    changed = True
+                if state in FINAL_STATES:
+                    pending.remove(name)
+            if changed:
+                self.print_table(tasks, states)
+            if not pending:
+                break
+
+            elapsed = time.monotonic() - start
+            if self.timeout and elapsed >= self.timeout:
+                logger.error("Timeout while watching tasks: {}".format(
+                    ", ".join(str(tasks[name]) for name in pending)))
+                break
+            # poll often while states are changing
+            if changed:
+                interval = self.min_interval
+            else:
+                interval = min(interval * POLL_BACKOFF, self.max_interval)
+            if self.timeout:
+                interval = min(interval, self.timeout - elapsed)
+            time.sleep(interval)
+        return states
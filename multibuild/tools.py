@@ -1,176 +1,344 @@
 # -*- coding: utf-8 -*-
 
-import configparser
-import getpass
+import collections
+import datetime
 import logging
-import re
+import os
+import shlex
+import shutil
+import signal
 import subprocess
+import threading
+import time
 import urllib
 
-import requests
+from .metrics import run_metrics
+from .resolver import BranchResolver
 
-DISTRIBUTION_TOOLS = {
-    "RHEL": ("rhpkg", "brew"),
-    "Fedora": ("fedpkg", "koji"),
-}
+ANSIBLE_TEMPLATE_ID = 'rcm-tools-compose-ss++Compose'
+ANSIBLE_JOB_FINAL_STATES = ("successful", "failed", "error", "canceled")
+ANSIBLE_POOL_SIZE = 10
+ANSIBLE_MAX_QUERY_FAILURES = 5
+# a launched job which isn't found by so many queries in a row is unknown
+ANSIBLE_MAX_UNSEEN_POLLS = 5
+ANSIBLE_FOLLOW_TIMEOUT = 2 * 60 * 60  # seconds
 
+# HTTP session shared by all threads; see 'get_ansible_session'
+_ansible_session = None
+_ansible_session_lock = threading.Lock()
 
-BRANCH_PATTERNS = {
-    r"^f\d\d$": "Fedora",  # f28 f29
-    r"^epel\d$": "Fedora",  # epel7
-    r"^epel\d\d(?:\.(\d+))?": "Fedora",  # epel10
-    r"^epel\d-playground$": "Fedora",  # epel8-playground
-    r"^el\d$": "Fedora",  # el6
-    r"^master|main|rawhide": "Fedora",  # Fedora rawhide (rpkg, fedpkg)
-    r"^eng-rhel-\d+$": "RHEL",  # eng-rhel-7 (rpkg, rhpkg)
-    r"^eng-fedora-\d\d$": "RHEL",  # eng-fedora-30 (rhpkg)
-}
+# executables found in PATH: {(program, PATH): path}; see '_resolve_executable'
+_executables = {}
+_executables_lock = threading.Lock()
 
-ANSIBLE_PLATFORM_MAPPING = {
-    r"eng-rhel-(\d+)": r"rhel-\1",
-    r"eng-fedora-(\d\d)": r"fedora-\1",
-}
 
-ANSIBLE_TEMPLATE_ID = 'rcm-tools-compose-ss++Compose'
+def command_line(command, shell=False):
+    """command (argv list or shell string) for logging purpose"""
+    if type(command) in (tuple, list):
+        return " ".join(command) if shell else shlex.join(command)
+    return command
+
+
+def _resolve_executable(program):
+    """
+    Full path of the program found in PATH. Lookups are cached per PATH value -
+    the same tools (git, rhpkg, brew) are executed for every branch.
+    """
+    path = os.environ.get("PATH", os.defpath)
+    with _executables_lock:
+        if (program, path) not in _executables:
+            _executables[(program, path)] = shutil.which(program, path=path) or program
+        return _executables[(program, path)]
+
+
+def _popen_args(command, shell):
+    """
+    Arguments of Popen: argv is executed directly; shell=True runs the command string
+    (or arguments joined into it) by /bin/sh.
+    """
+    if shell:
+        if type(command) in (tuple, list):
+            command = " ".join(command)
+        return command
+    if type(command) not in (tuple, list):
+        command = shlex.split(command)
+    if os.sep in command[0]:
+        return list(command)
+    return [_resolve_executable(command[0])] + list(command[1:])
+
+
+def _kill(proc, process_group):
+    try:
+        if process_group:
+            os.killpg(proc.pid, signal.SIGKILL)
+        else:
+            proc.kill()
+    except ProcessLookupError:
+        pass
 
 
-def execute_command(name, command="", pipe=None):
+def execute_command(name, command, cwd=None, started=None, on_line=None, shell=False,
+                    timeout=None):
+    """
+    Execute command and return its outputs and return code.
+    The command is argv list (or string split like in shell) executed directly;
+    shell=True executes it by shell (custom commands).
+    'started' callback is called once the process writes its first line of standard output
+    (or when it ends without it); the process has read its working directory by then.
+    Lines of errors don't count - rpkg prints warnings before it reads the directory.
+    'on_line' callback gets every line of output as it comes - on_line(line, is_error);
+    returned outputs are empty then.
+    The process (with its children) is killed after 'timeout' seconds.
+    """
     logger = logging.getLogger("execute_command")
-    # compose command string for logging purpose
-    if pipe:
-        command_str = "{} | {}".format(command, pipe)
-    else:
-        command_str = command
+    command_str = command_line(command, shell)
     logger.info("'{}'".format(command_str))
 
-    if pipe:
-        parent_proc = subprocess.Popen(
-            command,
-            shell=True,
-            cwd=None,
-            stdin=None,
-            universal_newlines=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
-        )
-        proc = subprocess.Popen(
-            pipe,
-            shell=True,
-            cwd=None,
-            stdin=parent_proc.stdout,
-            universal_newlines=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
-        )
-        parent_proc.stdout.close()
-    else:
+    run_metrics.count("subprocesses")
+    try:
         proc = subprocess.Popen(
-            command,
-            shell=True,
-            cwd=None,
+            _popen_args(command, shell),
+            shell=shell,
+            cwd=cwd,
             stdin=None,
             universal_newlines=True,
             stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
+            stderr=subprocess.PIPE,
+            # own process group - the process is killed with its children on timeout
+            start_new_session=bool(timeout),
         )
-    out, err = proc.communicate()
-    if proc.returncode != 0:
+    except OSError as e:
+        logger.error("During execution: '{}' in thread '{}': {}".format(command_str, name, e))
+        # the same as shell returns for unknown commands
+        return ("", str(e), 127)
+
+    timer = None
+    if timeout:
+        timer = threading.Timer(timeout, _kill, args=(proc, True))
+        timer.start()
+    try:
+        if started or on_line:
+            out, err = _communicate_lines(proc, started, on_line)
+        else:
+            out, err = proc.communicate()
+    finally:
+        if timer:
+            timer.cancel()
+    if timer and proc.returncode == -signal.SIGKILL:
+        message = "Timed out after {} s: '{}' in thread '{}'"
+        logger.error(message.format(timeout, command_str, name))
+    elif proc.returncode != 0:
         logger.error("During execution: '{}' in thread '{}'".format(command_str, name))
     return (out.strip(), err.strip(), proc.returncode)
 
 
-def detect_distribution(branches):
+def _communicate_lines(proc, started=None, on_line=None):
+    """
+    Same as proc.communicate(), but it reads outputs line by line.
+    It calls 'started' after the first line of standard output and passes lines
+    to 'on_line' instead of collecting them.
     """
-    Detect disribution from set of branches.
-    Accepts string (containing only one branch name) or list containing strings.
+    lock = threading.Lock()
+    notified = []
+
+    def notify():
+        with lock:
+            if started and not notified:
+                notified.append(True)
+                started()
+
+    def read(stream, lines, is_error):
+        for line in stream:
+            if not is_error:
+                notify()
+            if on_line:
+                on_line(line, is_error)
+            else:
+                lines.append(line)
+
+    out_lines = []
+    err_lines = []
+    readers = [
+        threading.Thread(target=read, args=(proc.stdout, out_lines, False)),
+        threading.Thread(target=read, args=(proc.stderr, err_lines, True)),
+    ]
+    for reader in readers:
+        reader.start()
+    for reader in readers:
+        reader.join()
+    proc.wait()
+    notify()
+    return "".join(out_lines), "".join(err_lines)
+
+
+async def execute_command_async(name, command, cwd=None, started=None, on_line=None,
+                                shell=False, timeout=None):
     """
-    if type(branches) in (tuple, list):
-        # make set of distributions from all branch names
-        distros = {_recognize_distribution(branch_name) for branch_name in branches}
-        if len(distros) == 1:
-            return distros.pop()  # return the only item from set
+    Coroutine version of 'execute_command'. The process is killed when the coroutine
+    is cancelled (e.g. on timeout of the branch) or after 'timeout' seconds.
+    """
+    import asyncio
+
+    logger = logging.getLogger("execute_command")
+    command_str = command_line(command, shell)
+    logger.info("'{}'".format(command_str))
+
+    run_metrics.count("subprocesses")
+    try:
+        if shell:
+            # own process group - children of the shell are killed with it
+            proc = await asyncio.create_subprocess_shell(
+                _popen_args(command, shell), cwd=cwd, stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE, start_new_session=True)
         else:
-            raise Exception("There are mixed branch names: {}".format(str(branches)))
-    else:
-        branch_name = branches
-        return _recognize_distribution(branch_name)
+            proc = await asyncio.create_subprocess_exec(
+                *_popen_args(command, shell), cwd=cwd,
+                stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    except OSError as e:
+        logger.error("During execution: '{}' in thread '{}': {}".format(command_str, name, e))
+        return ("", str(e), 127)
+
+    notified = []
+
+    def notify():
+        if started and not notified:
+            notified.append(True)
+            started()
+
+    async def read(stream, lines, is_error):
+        while True:
+            raw_line = await stream.readline()
+            if not raw_line:
+                break
+            if not is_error:
+                notify()
+            line = raw_line.decode(errors="replace")
+            if on_line:
+                on_line(line, is_error)
+            else:
+                lines.append(line)
+
+    out_lines = []
+    err_lines = []
+
+    async def communicate():
+        await asyncio.gather(read(proc.stdout, out_lines, False),
+                             read(proc.stderr, err_lines, True))
+        await proc.wait()
+
+    timed_out = False
+    try:
+        await asyncio.wait_for(communicate(), timeout)
+    except (asyncio.CancelledError, asyncio.TimeoutError) as e:
+        if proc.returncode is None:
+            _kill(proc, shell)
+            await proc.wait()
+        if isinstance(e, asyncio.CancelledError):
+            logger.error("Cancelled: '{}' in thread '{}'".format(command_str, name))
+            raise
+        timed_out = True
+        message = "Timed out after {} s: '{}' in thread '{}'"
+        logger.error(message.format(timeout, command_str, name))
+    finally:
+        notify()
+    if proc.returncode != 0 and not timed_out:
+        logger.error("During execution: '{}' in thread '{}'".format(command_str, name))
+    return ("".join(out_lines).strip(), "".join(err_lines).strip(), proc.returncode)
 
 
-def _recognize_distribution(branch_name):
+def prepare_worktree(branch, worktree_root, cwd=None):
     """
-    Detect disribution from branch name.
-    Internal method. Use "detect_distribution" instead.
+    Create a git worktree of the branch in the cache directory or reuse (and refresh)
+    the existing one. Every branch has its own working directory this way and threads
+    don't need to switch branches in the shared checkout.
+    cwd: directory of the dist-git repo
+    Returns path to the worktree or None.
+    """
+    logger = logging.getLogger("prepare_worktree")
+    path = os.path.realpath(os.path.join(worktree_root, branch.replace("/", "_")))
+
+    out, __, ret = execute_command(branch, ["git", "worktree", "list", "--porcelain"],
+                                   cwd=cwd)
+    if ret:
+        return None
+    registered = "worktree {}".format(path) in out.splitlines()
+
+    if registered and os.path.isdir(path):
+        logger.debug("Reusing worktree '{}'".format(path))
+        # refresh files - the branch could move since the last run
+        command = ["git", "checkout", "--force", "--ignore-other-worktrees", branch]
+        __, err, ret = execute_command(branch, command, cwd=path)
+    else:
+        logger.debug("Creating worktree '{}'".format(path))
+        # drop records about worktrees whose directories were removed
+        execute_command(branch, ["git", "worktree", "prune"], cwd=cwd)
+        if os.path.isdir(path):
+            # leftover of a worktree which isn't registered anymore
+            shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(worktree_root, exist_ok=True)
+        command = ["git", "worktree", "add", "--force", path, branch]
+        __, err, ret = execute_command(branch, command, cwd=cwd)
+    if ret:
+        logger.error("Worktree for branch '{}' wasn't prepared: {}".format(branch, err))
+        return None
+    return path
+
+
+def release_worktree(branch, path):
+    """
+    Detach HEAD of the branch's cached worktree, so the branch can be checked out
+    in the repo again (by hand or by runs without worktrees). Files stay for the next run.
     """
-    if not branch_name:
-        raise Exception("Empty branch name")
-    if type(branch_name) != str:
-        raise Exception("Branch name is not string")
+    logger = logging.getLogger("release_worktree")
+    __, err, ret = execute_command(branch, ["git", "checkout", "--quiet", "--detach"],
+                                   cwd=path)
+    if ret:
+        logger.warning("Worktree '{}' still holds branch '{}': {}".format(path, branch, err))
 
-    for pattern, arch in BRANCH_PATTERNS.items():
-        if re.match(pattern, branch_name):
-            return arch
 
-    logger = logging.getLogger("recognize_distribution")
-    logger.warning("Distribution wasn't recognized from branch '{}'. "
-                   "Using default: 'RHEL'".format(branch_name))
-    return "RHEL"
+def detect_distribution(branch_name):
+    """
+    Detect disribution from branch name.
+    """
+    return BranchResolver.get_default().distribution(branch_name)
 
 
 def get_distribution_tool(distribution):
-    dist_tool = DISTRIBUTION_TOOLS.get(distribution)
-    if not dist_tool:
-        raise Exception("Uknown distribution -> no tool detected")
-    return dist_tool
+    return BranchResolver.get_default().distribution_tool(distribution)
 
 
-def get_ansible_credentials(config):
-    logger = logging.getLogger("get_ansible_credentials")
-    url = None
-    try:
-        url = config.get("ansible", "url")
-        logger.info("Using 'ansible url' from config: '%s'" % url)
-    except (configparser.NoOptionError, configparser.NoSectionError):
-        url = input(prompt="Ansible url (ansible host): ")
-        if not url:
-            logger.error("Ansible url wasn't entered.")
-
-    username = None
-    try:
-        username = config.get("ansible", "username")
-        logger.info("Using 'ansible username' from config: '%s'" % username)
-    except (configparser.NoOptionError, configparser.NoSectionError):
-        username = input(prompt="Ansible username: ")
-        if not username:
-            logger.error("Ansible username wasn't entered.")
-
-    token = None
-    try:
-        token = config.get("ansible", "token")
-        # don't show token openly
-        logger.info("Using 'ansible token' from config: '%s'" % ("*" * len(token)))
-    except (configparser.NoOptionError, configparser.NoSectionError):
-        token = input(prompt="Ansible token: ")
-        if not token:
-            logger.error("Ansible token wasn't entered.")
-
-    password = ""
-    if not token:
-        try:
-            password = getpass.getpass()
-        except Exception as e:
-            logger.error("Ansible password error: %s" % e)
-        if not password:
-            logger.error("Ansible password wasn't entered.")
-
-    return url, username, password, token
+def get_dist_tag(branch_name):
+    """
+    dist tag of the branch or None when it is unknown
+    """
+    return BranchResolver.get_default().dist_tag(branch_name)
 
 
 def get_ansible_platform(branch_name):
-    for branch_pattern, platform_pattern in ANSIBLE_PLATFORM_MAPPING.items():
-        res = re.match(branch_pattern, branch_name)
-        if res:
-            return re.sub(branch_pattern, platform_pattern, branch_name)
-    return None
+    return BranchResolver.get_default().ansible_platform(branch_name)
+
+
+def get_ansible_session():
+    """
+    HTTP session (keep-alive connection pool) shared by all threads talking to ansible.
+    Failed connections and gateway errors are retried with backoff; job launch (POST)
+    is retried only when the connection wasn't established.
+    """
+    # requests are imported just by modes that need them - they are slow to import
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    global _ansible_session
+    with _ansible_session_lock:
+        if not _ansible_session:
+            retry = Retry(total=3, backoff_factor=1, status_forcelist=(502, 503, 504))
+            adapter = HTTPAdapter(max_retries=retry, pool_connections=1,
+                                  pool_maxsize=ANSIBLE_POOL_SIZE)
+            _ansible_session = requests.Session()
+            _ansible_session.mount("http://", adapter)
+            _ansible_session.mount("https://", adapter)
+        return _ansible_session
 
 
 def run_ansible_job(baseurl, username, password, token, branch_name, verrel):
@@ -197,7 +365,7 @@ def run_ansible_job(baseurl, username, password, token, branch_name, verrel):
     headers = {"Authorization": "Bearer {}".format(token)}
 
     try:
-        response = requests.post(
+        response = get_ansible_session().post(
             url,
             headers=headers,
             # verify=False,
@@ -222,20 +390,56 @@ def run_ansible_job(baseurl, username, password, token, branch_name, verrel):
     return job_id
 
 
-# NOTE: not really used yet
-def get_ansible_job_status(baseurl, username, password, token, job_id):
+def create_ansible_token(baseurl, username, password):
     """
-    Get status of the job in ansible with given ID.
-    Method returns job's status or None
+    Create a personal token of the user (authenticated by password) in ansible.
+    Method returns (token, expiration timestamp) or (None, None).
     """
-    logger = logging.getLogger("get_ansible_job_status")
-    url = urllib.parse.urljoin(baseurl, "/api/v2/jobs/%d/" % job_id)
+    logger = logging.getLogger("create_ansible_token")
+    url = urllib.parse.urljoin(baseurl, "/api/v2/tokens/")
+    try:
+        response = get_ansible_session().post(
+            url,
+            auth=(username, password),
+            json={"description": "multibuild", "scope": "write"})
+    except Exception as e:
+        logger.error("Error during processing ansible query: {}".format(e))
+        return None, None
+    if not response.ok:
+        logger.error("Ansible token wasn't created: {}".format(response))
+        logger.debug("Response: {}".format(response.text))
+        return None, None
+
+    try:
+        result = response.json()
+    except Exception as e:
+        logger.error("Error during parsing json response: {}".format(e))
+        return None, None
+    expires = None
+    if result.get("expires"):
+        # e.g. "2025-01-01T12:00:00.123456Z"
+        expires = datetime.datetime.strptime(result["expires"][:19], "%Y-%m-%dT%H:%M:%S")
+        expires = expires.replace(tzinfo=datetime.timezone.utc).timestamp()
+    return result.get("token"), expires
+
+
+def get_ansible_jobs(baseurl, token, job_ids):
+    """
+    Get data (status, elapsed time, ...) of all jobs with given IDs in one query.
+    Method returns {job_id: job data} or None
+    """
+    logger = logging.getLogger("get_ansible_jobs")
+    url = urllib.parse.urljoin(baseurl, "/api/v2/jobs/")
+    params = {
+        "id__in": ",".join(str(job_id) for job_id in job_ids),
+        "page_size": len(job_ids),
+    }
     headers = {"Authorization": "Bearer {}".format(token)}
     try:
-        response = requests.get(url, headers=headers)
+        response = get_ansible_session().get(url, headers=headers, params=params)
     except Exception as e:
         logger.error("Error during processing ansible query: {}".format(e))
-        raise
+        return
     if not response.ok:
         logger.error("Ansible response: {}".format(response))
         logger.debug("Response: {}".format(response.text))
@@ -245,8 +449,64 @@ def get_ansible_job_status(baseurl, username, password, token, job_id):
         result = response.json()
     except Exception as e:
         logger.error("Error during parsing json response: {}".format(e))
-        raise
-    status = result.get("status")
-    if not status:
-        logger.error("Job status wasn't found.")
-    return status
+        return
+    return {job["id"]: job for job in result.get("results", [])}
+
+
+def follow_ansible_jobs(baseurl, token, jobs, timeout=ANSIBLE_FOLLOW_TIMEOUT, min_interval=10,
+                        max_interval=60):
+    """
+    Poll all jobs {name: job_id} together until they reach a final state or the timeout
+    elapses. Method returns {name: job data}; job data is None when the job wasn't found.
+    """
+    logger = logging.getLogger("follow_ansible_jobs")
+    results = {name: None for name in jobs}
+    pending = {name: job_id for name, job_id in jobs.items() if job_id}
+    states = {}
+    unseen = collections.Counter()
+    start = time.monotonic()
+    interval = min_interval
+    failures = 0
+
+    while pending:
+        data = get_ansible_jobs(baseurl, token, list(pending.values()))
+        if data is None:
+            failures += 1
+            if failures >= ANSIBLE_MAX_QUERY_FAILURES:
+                logger.error("Giving up following jobs: {}".format(", ".join(pending)))
+                break
+            data = {}
+        else:
+            failures = 0
+        changed = False
+        for name, job_id in list(pending.items()):
+            job = data.get(job_id)
+            if not job and failures == 0:
+                # deleted or not visible with the token
+                unseen[name] += 1
+                if unseen[name] >= ANSIBLE_MAX_UNSEEN_POLLS:
+                    logger.error("'{}' job {} wasn't found".format(name, job_id))
+                    del pending[name]
+            if not job:
+                continue
+            unseen[name] = 0
+            results[name] = job
+            if states.get(name) != job.get("status"):
+                states[name] = job.get("status")
+                changed = True
+                logger.info("'{}' job {}: {}".format(name, job_id, job.get("status")))
+            if job.get("status") in ANSIBLE_JOB_FINAL_STATES:
+                del pending[name]
+        if not pending:
+            break
+
+        elapsed = time.monotonic() - start
+        if timeout and elapsed >= timeout:
+            logger.error("Timeout while following jobs: {}".format(", ".join(pending)))
+            break
+        # poll often while states are changing
+        interval = min_interval if changed else min(interval * 1.5, max_interval)
+        if timeout:
+            interval = min(interval, timeout - elapsed)
+        time.sleep(interval)
+    return results
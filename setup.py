@@ -21,7 +21,6 @@ setup(
         # "rhpkg",
         # "fedpkg",
         # "brewkoji",
-        # "jq",
     ],
     python_requires='>=3',
     test_suite='nose.collector',